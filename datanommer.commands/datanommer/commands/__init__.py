@@ -17,21 +17,29 @@ import importlib.metadata
 import itertools
 import json
 import logging
+import multiprocessing
+import os
+import sys
 import time
+from concurrent.futures import as_completed, ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import click
-from sqlalchemy import func, select
+from sqlalchemy import BigInteger, cast, func, select, text, tuple_
 
 import datanommer.models as m
 
-from .utils import config_option, get_config
+from .load import COPY_FORMATS, export_tables
+from .utils import config_option, EXTENSIONS, get_config, open_file
 
 
 __version__ = importlib.metadata.version("datanommer.commands")
 
 log = logging.getLogger("datanommer")
 
+# How long to wait for late messages before dumping them with --checkpoint
+CHECKPOINT_DELAY = timedelta(hours=1)
+
 
 @click.command()
 @config_option
@@ -50,38 +58,336 @@ def create(config_path):
 @config_option
 @click.option("--since", default=None, help="Only after datetime, ex 2013-02-14T08:05:59.87")
 @click.option("--before", default=None, help="Only before datetime, ex 2013-02-14T08:05:59.87")
-def dump(config_path, since, before):
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["json", "ndjson"]),
+    default="json",
+    show_default=True,
+    help="Output a JSON list, or one JSON message per line",
+)
+@click.option(
+    "--chunk-size",
+    default=1000,
+    show_default=True,
+    help="Number of messages to fetch from the database at a time",
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    type=click.Path(file_okay=False, writable=True),
+    default=None,
+    help="Write compressed NDJSON files and a manifest to this directory",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of processes dumping to the output directory",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["gzip", "zstd", "none"]),
+    default="gzip",
+    show_default=True,
+    help="Compression of the files in the output directory",
+)
+@click.option(
+    "--copy",
+    "copy_format",
+    type=click.Choice(COPY_FORMATS),
+    default=None,
+    help="Copy the tables to the output directory in this format, for datanommer-load",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Resume after the last message recorded in this file, and record the progress",
+)
+def dump(
+    config_path,
+    since,
+    before,
+    output_format,
+    chunk_size,
+    output_dir,
+    jobs,
+    compression,
+    copy_format,
+    checkpoint,
+):
     """Dump the contents of the datanommer database as JSON.
 
     You can also specify a timespan with the --since and --before arguments:
 
         $ datanommer-dump --before 2013-02-15 --since 2013-02-11T08:00:00 > datanommer-dump.json
+
+    The messages are written as they are read from the database, and the progress is
+    reported on stderr. Use --format ndjson to get one message per line, which can be
+    processed without loading the whole dump:
+
+        $ datanommer-dump --format ndjson --since 2013-02-11 > datanommer-dump.ndjson
+
+    With --output-dir, the timespan is split in time slices following the TimescaleDB
+    chunks, and each slice is written to its own compressed NDJSON file. The slices are
+    dumped by --jobs processes in parallel, and the list of files is written to
+    manifest.json:
+
+        $ datanommer-dump --since 2013-01-01 --before 2014-01-01 -o dump-2013 --jobs 4
+
+    With --copy, the database tables are copied to the output directory with
+    PostgreSQL's COPY instead, which is much faster. Such a dump can be loaded into
+    another database with datanommer-load:
+
+        $ datanommer-dump --since 2013-01-01 -o dump-2013 --copy binary
+
+    With --checkpoint, the last dumped message is recorded in a file after each chunk,
+    and the next run starts after it. This makes incremental NDJSON archives possible,
+    and an interrupted dump resumes where it stopped:
+
+        $ datanommer-dump --format ndjson --checkpoint archive.state >> archive.ndjson
+
+    Messages can be stored a little after they were sent, so without --before a
+    checkpointed dump stops at the messages sent one hour ago.
     """
     config = get_config(config_path)
     m.init(
         config["datanommer_sqlalchemy_url"],
         alembic_ini=config["alembic_ini"],
     )
+    if jobs > 1 and not output_dir:
+        raise click.UsageError("--jobs requires --output-dir")
+    if copy_format and not output_dir:
+        raise click.UsageError("--copy requires --output-dir")
+    if checkpoint and (output_format != "ndjson" or output_dir or copy_format):
+        raise click.UsageError("--checkpoint requires --format ndjson, without --output-dir")
+    if output_dir and compression == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError as e:
+            raise click.ClickException(
+                "The zstandard package is required for zstd, install datanommer.commands[zstd]"
+            ) from e
 
     query = select(m.Message)
     if before:
-        try:
-            before = datetime.fromisoformat(before)
-        except ValueError as e:
-            raise click.ClickException("Invalid date format") from e
-
+        before = _parse_datetime(before)
         query = query.where(m.Message.timestamp <= before)
 
     if since:
-        try:
-            since = datetime.fromisoformat(since)
-        except ValueError as e:
-            raise click.ClickException("Invalid date format") from e
-
+        since = _parse_datetime(since)
         query = query.where(m.Message.timestamp >= since)
 
-    results = [json.dumps(msg.as_fedora_message_dict()) for msg in m.session.scalars(query)]
-    click.echo(f"[{','.join(results)}]")
+    if checkpoint:
+        position = _read_checkpoint(checkpoint)
+        if position is not None:
+            timestamp, message_id = position
+            query = query.where(
+                m.Message.timestamp >= timestamp,
+                tuple_(m.Message.timestamp, m.Message.id) > (timestamp, message_id),
+            )
+        if not before:
+            now = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+            query = query.where(m.Message.timestamp <= now - CHECKPOINT_DELAY)
+
+    if copy_format:
+        manifest = export_tables(output_dir, since, before, copy_format, compression)
+        for copied_file in manifest["files"]:
+            click.echo(f"Copied {copied_file['rows']} rows from {copied_file['table']}", err=True)
+        return
+
+    if output_dir:
+        _dump_to_files(
+            config["datanommer_sqlalchemy_url"],
+            output_dir,
+            since,
+            before,
+            jobs=jobs,
+            compression=compression,
+            chunk_size=chunk_size,
+        )
+        return
+
+    # The estimate is enough for the progress bar, counting would read everything twice.
+    total = m.Message.count_query(query, "estimate")
+    query = query.order_by(m.Message.timestamp, m.Message.id)
+
+    output = click.get_text_stream("stdout")
+    with click.progressbar(length=total, label="Dumping messages", file=sys.stderr) as bar:
+        if output_format == "json":
+            output.write("[")
+        message = None
+        for index, message in enumerate(m.Message.stream_query(query, batch_size=chunk_size)):
+            record = json.dumps(message.as_fedora_message_dict())
+            if output_format == "ndjson":
+                output.write(f"{record}\n")
+            elif index:
+                output.write(f",{record}")
+            else:
+                output.write(record)
+            bar.update(1)
+            if checkpoint and (index + 1) % chunk_size == 0:
+                output.flush()
+                _write_checkpoint(checkpoint, message)
+        if output_format == "json":
+            output.write("]\n")
+        if checkpoint and message is not None:
+            output.flush()
+            _write_checkpoint(checkpoint, message)
+    click.echo(f"Dumped {bar.pos} messages", err=True)
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as checkpoint_file:
+            position = json.load(checkpoint_file)
+        return datetime.fromisoformat(position["timestamp"]), int(position["id"])
+    except FileNotFoundError:
+        return None
+    except (ValueError, TypeError, KeyError) as e:
+        raise click.ClickException(f"Invalid checkpoint file: {path}") from e
+
+
+def _write_checkpoint(path, message):
+    with open(f"{path}.tmp", "w") as checkpoint_file:
+        json.dump({"timestamp": message.timestamp.isoformat(), "id": message.id}, checkpoint_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def _parse_datetime(value):
+    """Parse a datetime option, as naive UTC like the timestamps in the database."""
+    try:
+        value = datetime.fromisoformat(value)
+    except ValueError as e:
+        raise click.ClickException("Invalid date format") from e
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _dump_to_files(url, output_dir, since, before, jobs, compression, chunk_size):
+    if since is None or before is None:
+        first, last = m.session.execute(
+            select(func.min(m.Message.timestamp), func.max(m.Message.timestamp))
+        ).one()
+        since = since or first
+        before = before or last
+    if since is None or before is None or since > before:
+        # Nothing to dump
+        slices = []
+    else:
+        # The slices don't include their end, but --before does.
+        slices = _get_time_slices(since, before + timedelta(microseconds=1), jobs)
+
+    os.makedirs(output_dir, exist_ok=True)
+    files = [
+        (f"messages-{start:%Y%m%dT%H%M%S%f}.ndjson{EXTENSIONS[compression]}", start, end)
+        for start, end in slices
+    ]
+    counts = {}
+    with click.progressbar(length=len(files), label="Dumping time slices", file=sys.stderr) as bar:
+        if jobs == 1:
+            for filename, start, end in files:
+                path = os.path.join(output_dir, filename)
+                counts[filename] = _dump_slice(path, start, end, compression, chunk_size)
+                bar.update(1)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_dump_worker,
+                initargs=(url,),
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _dump_slice,
+                        os.path.join(output_dir, filename),
+                        start,
+                        end,
+                        compression,
+                        chunk_size,
+                    ): filename
+                    for filename, start, end in files
+                }
+                for future in as_completed(futures):
+                    counts[futures[future]] = future.result()
+                    bar.update(1)
+
+    manifest = {
+        "since": since.isoformat() if since else None,
+        "before": before.isoformat() if before else None,
+        "format": "ndjson",
+        "compression": compression,
+        "messages": sum(counts.values()),
+        "files": [
+            {
+                "name": filename,
+                "start": start.isoformat(),
+                "end": end.isoformat(),
+                "messages": counts[filename],
+            }
+            for filename, start, end in files
+        ],
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    click.echo(f"Dumped {manifest['messages']} messages to {len(files)} files", err=True)
+
+
+def _get_time_slices(start, end, count):
+    """Split the time between start and end in at least ``count`` slices.
+
+    The slices follow the boundaries of the TimescaleDB chunks, so that each slice reads
+    as few chunks as possible. Without enough chunks, the time is split evenly. There
+    are fewer slices if the time span is too short to be split in ``count``, since the
+    slices can't be empty.
+    """
+    boundaries = []
+    if m.session.scalar(text("SELECT to_regclass('timescaledb_information.chunks')")):
+        for boundary in m.session.scalars(
+            text(
+                "SELECT DISTINCT range_start FROM timescaledb_information.chunks "
+                "WHERE hypertable_name = 'messages'"
+            )
+        ):
+            if boundary.tzinfo is not None:
+                boundary = boundary.astimezone(timezone.utc).replace(tzinfo=None)
+            if start < boundary < end:
+                boundaries.append(boundary)
+    if len(boundaries) + 1 < count:
+        step = (end - start) / count
+        boundaries = [start + step * index for index in range(1, count)]
+    # Very short time spans give duplicate boundaries
+    boundaries = sorted({start, *boundaries, end})
+    return list(itertools.pairwise(boundaries))
+
+
+def _init_dump_worker(url):
+    m.init(url)
+
+
+def _dump_slice(path, start, end, compression, chunk_size):
+    """Write the messages sent between start (included) and end (excluded) to a file.
+
+    The file is written under a temporary name and renamed when it is complete.
+    Returns the number of messages.
+    """
+    query = (
+        select(m.Message)
+        .where(m.Message.timestamp >= start, m.Message.timestamp < end)
+        .order_by(m.Message.timestamp, m.Message.id)
+    )
+    count = 0
+    with open_file(f"{path}.part", compression) as output:
+        for message in m.Message.stream_query(query, batch_size=chunk_size):
+            output.write(f"{json.dumps(message.as_fedora_message_dict())}\n")
+            count += 1
+    m.session.rollback()
+    os.replace(f"{path}.part", path)
+    return count
 
 
 @click.command()
@@ -136,16 +442,15 @@ def stats(config_path, topic, category):
         alembic_ini=config["alembic_ini"],
     )
 
-    if topic:
-        query = select(m.Message.topic, func.count(m.Message.topic))
-        if category:
-            query = query.where(m.Message.category == category)
-        query = query.group_by(m.Message.topic)
-    else:
-        query = select(m.Message.category, func.count(m.Message.category))
-        if category:
-            query = query.where(m.Message.category == category)
-        query = query.group_by(m.Message.category)
+    # The hourly counts are pre-computed by TimescaleDB, only the latest messages are
+    # counted from the messages table.
+    hourly = m.messages_hourly
+    group_column = hourly.c.topic if topic else hourly.c.category
+    query = select(group_column, cast(func.sum(hourly.c.messages), BigInteger)).group_by(
+        group_column
+    )
+    if category:
+        query = query.where(hourly.c.category == category)
 
     results = m.session.execute(query).all()
 
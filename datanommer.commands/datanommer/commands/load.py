@@ -0,0 +1,202 @@
+"""Copy the datanommer tables to files and load them back with PostgreSQL's COPY.
+
+This is much faster than going through the models, which makes it suitable to restore
+a staging database from a production dump.
+"""
+
+import json
+import logging
+import os
+
+import click
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+import datanommer.models as m
+
+from .utils import config_option, EXTENSIONS, get_config, open_file
+
+
+log = logging.getLogger(__name__)
+
+COPY_FORMATS = ("binary", "csv")
+
+# Insert the users and packages that don't exist yet. The associations are matched on
+# their names, since the ids in the dump don't mean anything in this database.
+LOAD_NAMES = (
+    "INSERT INTO {table} (name) SELECT name FROM load_{table} ON CONFLICT (name) DO NOTHING"
+)
+# Insert the messages that are not in the database yet with new ids, and remember the
+# mapping between the dumped ids and the new ones.
+LOAD_MESSAGES = """
+    WITH inserted AS (
+        INSERT INTO messages ({columns})
+        SELECT {columns} FROM load_messages ORDER BY timestamp
+        ON CONFLICT (msg_id, timestamp) DO NOTHING
+        RETURNING id, msg_id, timestamp
+    )
+    INSERT INTO load_message_map (old_id, new_id, msg_id, timestamp)
+    SELECT load_messages.id, inserted.id, inserted.msg_id, inserted.timestamp
+    FROM inserted JOIN load_messages USING (msg_id, timestamp)
+"""
+LOAD_ASSOCIATIONS = """
+    INSERT INTO {assoc_table} ({key}, msg_id, msg_timestamp)
+    SELECT {table}.id, load_message_map.new_id, load_message_map.timestamp
+    FROM load_{assoc_table}
+    JOIN load_message_map
+        ON load_message_map.old_id = load_{assoc_table}.msg_id
+        AND load_message_map.timestamp = load_{assoc_table}.msg_timestamp
+    JOIN load_{table} ON load_{table}.id = load_{assoc_table}.{key}
+    JOIN {table} ON {table}.name = load_{table}.name
+    ON CONFLICT DO NOTHING
+"""
+
+
+def _get_tables():
+    """Return the tables to copy, in loading order, with their time column."""
+    return [
+        (m.User.__table__, None),
+        (m.Package.__table__, None),
+        (m.Message.__table__, m.Message.__table__.c.timestamp),
+        (m.users_assoc_table, m.users_assoc_table.c.msg_timestamp),
+        (m.packages_assoc_table, m.packages_assoc_table.c.msg_timestamp),
+    ]
+
+
+def _get_cursor():
+    return m.session.connection().connection.cursor()
+
+
+def export_tables(output_dir, since, before, copy_format, compression):
+    """Write the tables to ``output_dir`` with ``COPY ... TO STDOUT``.
+
+    Only the messages sent between ``since`` and ``before`` are copied, but all the users
+    and packages are. The tables are read in a single ``REPEATABLE READ`` transaction, so
+    that they are consistent with each other. The columns are listed in the manifest, in
+    the order of the models, since the order of the columns in the database depends on
+    the migrations that were run. Returns the manifest.
+    """
+    m.session.rollback()
+    m.session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    cursor = _get_cursor()
+    dialect = postgresql.psycopg2.dialect()
+    os.makedirs(output_dir, exist_ok=True)
+    files = []
+    for table, time_column in _get_tables():
+        columns = [column.name for column in table.columns]
+        query = select(*table.columns)
+        if time_column is not None and since is not None:
+            query = query.where(time_column >= since)
+        if time_column is not None and before is not None:
+            query = query.where(time_column <= before)
+        compiled = query.compile(dialect=dialect)
+        query_sql = cursor.mogrify(str(compiled), compiled.params).decode()
+        filename = f"{table.name}.{copy_format}{EXTENSIONS[compression]}"
+        with open_file(os.path.join(output_dir, filename), compression, "wb") as output:
+            cursor.copy_expert(f"COPY ({query_sql}) TO STDOUT WITH (FORMAT {copy_format})", output)
+        files.append(
+            {"table": table.name, "name": filename, "columns": columns, "rows": cursor.rowcount}
+        )
+    m.session.rollback()
+
+    manifest = {
+        "since": since.isoformat() if since else None,
+        "before": before.isoformat() if before else None,
+        "format": copy_format,
+        "compression": compression,
+        "files": files,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def load_tables(input_dir, manifest):
+    """Load the files written by :func:`export_tables` in the current transaction.
+
+    The files are copied to temporary tables first. The users and packages are matched
+    by name and created if necessary, so their ids may differ from the dumped ones. The
+    messages get new ids, and the ones that are already in the database (with the same
+    ``msg_id`` and timestamp) are skipped along with their users and packages.
+
+    Returns the number of loaded messages and the number of skipped messages.
+    """
+    if manifest.get("format") not in COPY_FORMATS or manifest.get("compression") not in EXTENSIONS:
+        raise click.ClickException(f"{input_dir} does not contain a COPY dump")
+    files = {dumped_file["table"]: dumped_file for dumped_file in manifest["files"]}
+    cursor = _get_cursor()
+    for table, _time_column in _get_tables():
+        try:
+            dumped_file = files[table.name]
+        except KeyError as e:
+            raise click.ClickException(f"The {table.name} table is missing from the dump") from e
+        columns = dumped_file.get("columns") or []
+        if sorted(columns) != sorted(column.name for column in table.columns):
+            raise click.ClickException(f"The columns of the {table.name} table don't match")
+        # The table and column names come from the models, not from the manifest.
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE load_{table.name} (LIKE {table.name}) ON COMMIT DROP"
+        )
+        path = os.path.join(input_dir, os.path.basename(dumped_file["name"]))
+        with open_file(path, manifest["compression"], "rb") as input_file:
+            cursor.copy_expert(
+                f"COPY load_{table.name} ({', '.join(columns)}) FROM STDIN "
+                f"WITH (FORMAT {manifest['format']})",
+                input_file,
+            )
+
+    for table in ("users", "packages"):
+        cursor.execute(LOAD_NAMES.format(table=table))
+    cursor.execute(
+        "CREATE TEMPORARY TABLE load_message_map "
+        "(old_id integer, new_id integer, msg_id varchar, timestamp timestamp) ON COMMIT DROP"
+    )
+    columns = [column.name for column in m.Message.__table__.columns if column.name != "id"]
+    cursor.execute(LOAD_MESSAGES.format(columns=", ".join(columns)))
+    for assoc_table, table, key in (
+        ("users_messages", "users", "user_id"),
+        ("packages_messages", "packages", "package_id"),
+    ):
+        cursor.execute(LOAD_ASSOCIATIONS.format(assoc_table=assoc_table, table=table, key=key))
+    cursor.execute(
+        "INSERT INTO message_ids (msg_id, timestamp) SELECT msg_id, timestamp "
+        "FROM load_message_map ON CONFLICT (msg_id) DO NOTHING"
+    )
+
+    cursor.execute("SELECT count(*) FROM load_message_map")
+    loaded = cursor.fetchone()[0]
+    cursor.execute("SELECT count(*) FROM load_messages")
+    return loaded, cursor.fetchone()[0] - loaded
+
+
+@click.command()
+@config_option
+@click.argument("input_dir", type=click.Path(exists=True, file_okay=False))
+def main(config_path, input_dir):
+    """Load a dump made with datanommer-dump --copy into the database.
+
+    The users and packages are matched by name, and the messages that are already in the
+    database are skipped, so a dump can be loaded into a database that already has
+    messages, or loaded twice:
+
+        $ datanommer-dump --copy binary -o prod-dump --since 2024-01-01
+        $ datanommer-load prod-dump
+    """
+    config = get_config(config_path)
+    m.init(
+        config["datanommer_sqlalchemy_url"],
+        alembic_ini=config["alembic_ini"],
+    )
+    try:
+        with open(os.path.join(input_dir, "manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError as e:
+        raise click.ClickException(f"{input_dir} does not contain a manifest.json file") from e
+
+    try:
+        loaded, skipped = load_tables(input_dir, manifest)
+    except Exception:
+        m.session.rollback()
+        raise
+    m.session.commit()
+    click.echo(f"Loaded {loaded} messages, skipped {skipped} already in the database")
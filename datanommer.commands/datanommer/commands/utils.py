@@ -1,3 +1,4 @@
+import gzip
 import logging
 
 import click
@@ -10,6 +11,8 @@ import datanommer.models as m
 
 # Go trough messages these many at a time
 CHUNK_SIZE = 10000
+# File extensions of the supported compressions
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "none": ""}
 log = logging.getLogger(__name__)
 
 
@@ -63,3 +66,15 @@ def iterate_over_messages(query, start, chunk_size):
             first_run = False
             m.session.commit()
             m.session.expunge_all()
+
+
+def open_file(path, compression, mode="wt"):
+    """Open a file compressed with gzip, zstd (if installed) or "none"."""
+    kwargs = {"encoding": "utf-8"} if "t" in mode else {}
+    if compression == "gzip":
+        return gzip.open(path, mode, **kwargs)
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.open(path, mode, **kwargs)
+    return open(path, mode, **kwargs)
@@ -0,0 +1 @@
+Read the counts of ``datanommer-stats`` from the hourly continuous aggregate
@@ -0,0 +1,2 @@
+Let ``datanommer-dump`` write gzip or zstd compressed files to a directory, with
+several jobs in parallel
@@ -0,0 +1,2 @@
+Stream the output of ``datanommer-dump``, with a progress bar and an ``ndjson``
+output format
@@ -0,0 +1,2 @@
+Add a ``--checkpoint`` option to ``datanommer-dump``, to only dump the new messages
+on each run
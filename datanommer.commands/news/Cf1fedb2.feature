@@ -0,0 +1,2 @@
+Add a ``--copy`` option to ``datanommer-dump`` and the ``datanommer-load`` command,
+to copy the tables with PostgreSQL's ``COPY``
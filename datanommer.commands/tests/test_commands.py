@@ -13,6 +13,8 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import itertools
 import json
 import time
 from datetime import datetime, timedelta
@@ -20,6 +22,7 @@ from datetime import datetime, timedelta
 import pytest
 from click import ClickException
 from click.testing import CliRunner
+from sqlalchemy import select
 
 import datanommer.commands
 import datanommer.models as m
@@ -96,6 +99,21 @@ def test_stats(datanommer_models, mock_config, mock_init):
     assert "fas has 1 entries" in result.output
 
 
+def test_stats_hourly(datanommer_models, mock_config, mock_init, mocker):
+    for hour in range(3):
+        msg = generate_message(topic="org.fedoraproject.prod.git.branch.valgrind.master")
+        msg._properties.headers["sent-at"] = datetime(2013, 2, 14, hour).isoformat()
+        m.add(msg)
+    m.add(generate_message(topic="org.fedoraproject.stg.fas.user.create"))
+    execute = mocker.spy(m.session, "execute")
+
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.stats, [])
+    assert result.exit_code == 0, result.output
+    assert sorted(result.output.splitlines()) == ["fas has 1 entries", "git has 3 entries"]
+    assert "messages_hourly" in str(execute.call_args.args[0])
+
+
 def test_stats_topics(datanommer_models, mock_config, mock_init):
     msg1 = generate_message(
         topic="org.fedoraproject.prod.git.branch.valgrind.master",
@@ -185,11 +203,11 @@ def test_dump(datanommer_models, mock_config, mock_init):
     msg3 = generate_bodhi_update_complete_message()
     m.add(msg3)
 
-    runner = CliRunner()
+    runner = CliRunner(mix_stderr=False)
     result = runner.invoke(datanommer.commands.dump, [])
     assert result.exit_code == 0, result.output
 
-    json_object = json.loads(result.output)
+    json_object = json.loads(result.stdout)
 
     assert json_object[0]["topic"] == "org.fedoraproject.prod.git.branch.valgrind.master"
 
@@ -207,11 +225,11 @@ def test_dump_before(datanommer_models, mock_config, mock_init):
     msg3._properties.headers["sent-at"] = datetime(2013, 2, 16, 8).isoformat()
     m.add(msg3)
 
-    runner = CliRunner()
+    runner = CliRunner(mix_stderr=False)
     result = runner.invoke(datanommer.commands.dump, ["--before", "2013-02-16"])
     assert result.exit_code == 0, result.output
 
-    json_object = json.loads(result.output)
+    json_object = json.loads(result.stdout)
 
     assert json_object[0]["topic"] == "org.fedoraproject.prod.git.branch.valgrind.master"
     assert json_object[1]["topic"] == "org.fedoraproject.prod.git.receive.valgrind.master"
@@ -231,11 +249,11 @@ def test_dump_since(datanommer_models, mock_config, mock_init):
     msg3._properties.headers["sent-at"] = datetime(2013, 2, 16, 8).isoformat()
     m.add(msg3)
 
-    runner = CliRunner()
+    runner = CliRunner(mix_stderr=False)
     result = runner.invoke(datanommer.commands.dump, ["--since", "2013-02-14T08:00:00"])
     assert result.exit_code == 0, result.output
 
-    json_object = json.loads(result.output)
+    json_object = json.loads(result.stdout)
 
     assert json_object[0]["topic"] == "org.fedoraproject.prod.git.receive.valgrind.master"
     assert json_object[1]["topic"] == "org.fedoraproject.prod.log.receive.valgrind.master"
@@ -255,19 +273,325 @@ def test_dump_timespan(datanommer_models, mock_config, mock_init):
     msg3._properties.headers["sent-at"] = datetime(2013, 2, 16, 8).isoformat()
     m.add(msg3)
 
-    runner = CliRunner()
+    runner = CliRunner(mix_stderr=False)
     result = runner.invoke(
         datanommer.commands.dump,
         ["--before", "2013-02-16", "--since", "2013-02-14T08:00:00"],
     )
     assert result.exit_code == 0, result.output
 
-    json_object = json.loads(result.output)
+    json_object = json.loads(result.stdout)
 
     assert json_object[0]["topic"] == "org.fedoraproject.prod.git.receive.valgrind.master"
     assert len(json_object) == 1
 
 
+def test_dump_timespan_timezone(datanommer_models, mock_config, mock_init, tmp_path):
+    for day, hour in ((14, 0), (15, 0), (16, 8)):
+        msg = generate_message(topic=f"org.fedoraproject.prod.test.{day}")
+        msg._properties.headers["sent-at"] = datetime(2013, 2, day, hour).isoformat()
+        m.add(msg)
+    # 2013-02-14T08:00:00 and 2013-02-16T00:00:00 in UTC
+    timespan = ["--since", "2013-02-14T10:00:00+02:00", "--before", "2013-02-15T20:00:00-04:00"]
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, timespan)
+    assert result.exit_code == 0, result.stderr
+    assert [msg["topic"] for msg in json.loads(result.stdout)] == ["org.fedoraproject.prod.test.15"]
+
+    result = runner.invoke(datanommer.commands.dump, [*timespan, "-o", str(tmp_path)])
+    assert result.exit_code == 0, result.stderr
+    assert [msg["topic"] for msg in _read_dump_dir(tmp_path)[1]] == [
+        "org.fedoraproject.prod.test.15"
+    ]
+
+
+def test_dump_empty(datanommer_models, mock_config, mock_init):
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, [])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.stdout) == []
+
+    result = runner.invoke(datanommer.commands.dump, ["--format", "ndjson"])
+    assert result.exit_code == 0, result.output
+    assert result.stdout == ""
+
+
+def test_dump_ndjson(datanommer_models, mock_config, mock_init):
+    for day in range(1, 6):
+        msg = generate_message(topic=f"org.fedoraproject.prod.test.{day}")
+        msg._properties.headers["sent-at"] = datetime(2013, 2, day).isoformat()
+        m.add(msg)
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["--format", "ndjson", "--chunk-size", "2"])
+    assert result.exit_code == 0, result.output
+
+    lines = result.stdout.splitlines()
+    assert [json.loads(line)["topic"] for line in lines] == [
+        f"org.fedoraproject.prod.test.{day}" for day in range(1, 6)
+    ]
+
+
+def test_dump_streams(datanommer_models, mock_config, mock_init):
+    for _ in range(5):
+        msg = generate_message(topic="org.fedoraproject.prod.git.branch.valgrind.master")
+        msg._properties.headers["usernames"] = ["dummy"]
+        m.add(msg)
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["--chunk-size", "2"])
+    assert result.exit_code == 0, result.output
+
+    json_object = json.loads(result.stdout)
+    assert len(json_object) == 5
+    assert all(msg["headers"]["usernames"] == ["dummy"] for msg in json_object)
+    assert "Dumped 5 messages" in result.stderr
+    # The dumped messages are not kept in the session
+    assert not any(isinstance(obj, m.Message) for obj in m.session)
+
+
+def _add_daily_messages(days):
+    for day in range(1, days + 1):
+        msg = generate_message(topic=f"org.fedoraproject.prod.test.{day}")
+        msg._properties.headers["sent-at"] = datetime(2013, 2, day).isoformat()
+        m.add(msg)
+
+
+def _read_dump_dir(path):
+    with open(path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    messages = []
+    for dumped_file in manifest["files"]:
+        with gzip.open(path / dumped_file["name"], "rt") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == dumped_file["messages"]
+        messages.extend(json.loads(line) for line in lines)
+    return manifest, messages
+
+
+def test_dump_output_dir(datanommer_models, mock_config, mock_init, tmp_path):
+    _add_daily_messages(5)
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(
+        datanommer.commands.dump,
+        ["--since", "2013-02-02", "--before", "2013-02-04", "-o", str(tmp_path / "dump")],
+    )
+    assert result.exit_code == 0, result.stderr
+    assert result.stdout == ""
+    assert "Dumped 3 messages to 1 files" in result.stderr
+
+    manifest, messages = _read_dump_dir(tmp_path / "dump")
+    assert manifest["messages"] == 3
+    assert manifest["compression"] == "gzip"
+    assert [msg["topic"] for msg in messages] == [
+        f"org.fedoraproject.prod.test.{day}" for day in range(2, 5)
+    ]
+    assert not list((tmp_path / "dump").glob("*.part"))
+
+
+def test_dump_output_dir_empty(datanommer_models, mock_config, mock_init, tmp_path):
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(
+        datanommer.commands.dump,
+        ["-o", str(tmp_path), "--compression", "none"],
+    )
+    assert result.exit_code == 0, result.stderr
+    manifest, messages = _read_dump_dir(tmp_path)
+    assert manifest["files"] == []
+    assert manifest["since"] is None
+
+
+def test_dump_output_dir_uncompressed(datanommer_models, mock_config, mock_init, tmp_path):
+    _add_daily_messages(2)
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--compression", "none"])
+    assert result.exit_code == 0, result.stderr
+    with open(tmp_path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["since"] == "2013-02-01T00:00:00"
+    assert manifest["before"] == "2013-02-02T00:00:00"
+    (dumped_file,) = manifest["files"]
+    assert dumped_file["name"].endswith(".ndjson")
+    assert len((tmp_path / dumped_file["name"]).read_text().splitlines()) == 2
+
+
+def test_dump_jobs(datanommer_models, mock_config, datanommer_db_url, mocker, tmp_path):
+    mocker.patch.dict(
+        datanommer.commands.utils.fedora_messaging_config.conf["consumer_config"],
+        {"datanommer_sqlalchemy_url": datanommer_db_url},
+    )
+    _add_daily_messages(5)
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--jobs", "2"])
+    assert result.exit_code == 0, result.stderr
+
+    manifest, messages = _read_dump_dir(tmp_path)
+    assert manifest["messages"] == 5
+    assert len(manifest["files"]) >= 2
+    assert sorted(msg["topic"] for msg in messages) == [
+        f"org.fedoraproject.prod.test.{day}" for day in range(1, 6)
+    ]
+
+
+def test_dump_jobs_without_output_dir(datanommer_models, mock_config, mock_init):
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.dump, ["--jobs", "2"])
+    assert result.exit_code == 2
+    assert "--jobs requires --output-dir" in result.output
+
+
+def test_dump_zstd_not_installed(datanommer_models, mock_config, mock_init, mocker, tmp_path):
+    mocker.patch.dict("sys.modules", {"zstandard": None})
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--compression", "zstd"])
+    assert result.exit_code == 1
+    assert "The zstandard package is required for zstd" in result.output
+
+
+def test_dump_worker_functions(mocker, tmp_path):
+    # These run in the worker processes, test them here too.
+    mock_init = mocker.patch("datanommer.commands.m.init")
+    datanommer.commands._init_dump_worker("TESTURL")
+    mock_init.assert_called_once_with("TESTURL")
+
+    zstandard = mocker.Mock()
+    mocker.patch.dict("sys.modules", {"zstandard": zstandard})
+    output = datanommer.commands.utils.open_file(tmp_path / "dump.zst", "zstd")
+    assert output is zstandard.open.return_value
+    zstandard.open.assert_called_once_with(tmp_path / "dump.zst", "wt", encoding="utf-8")
+
+
+def test_get_time_slices(datanommer_models):
+    start = datetime(2013, 2, 1)
+    end = datetime(2013, 3, 1)
+    slices = datanommer.commands._get_time_slices(start, end, 4)
+    assert len(slices) >= 4
+    assert slices[0][0] == start
+    assert slices[-1][1] == end
+    for (_, previous_end), (next_start, _) in itertools.pairwise(slices):
+        assert previous_end == next_start
+
+
+@pytest.mark.parametrize("microseconds,expected", [(1, 1), (3, 3), (7, 4)])
+def test_get_time_slices_short(datanommer_models, microseconds, expected):
+    start = datetime(2013, 2, 1)
+    end = start + timedelta(microseconds=microseconds)
+    slices = datanommer.commands._get_time_slices(start, end, 4)
+    assert len(slices) == expected
+    assert slices[0][0] == start
+    assert slices[-1][1] == end
+    assert all(slice_start < slice_end for slice_start, slice_end in slices)
+
+
+def test_dump_jobs_single_message(
+    datanommer_models, mock_config, datanommer_db_url, mocker, tmp_path
+):
+    mocker.patch.dict(
+        datanommer.commands.utils.fedora_messaging_config.conf["consumer_config"],
+        {"datanommer_sqlalchemy_url": datanommer_db_url},
+    )
+    _add_daily_messages(1)
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--jobs", "4"])
+    assert result.exit_code == 0, result.stderr
+    manifest, messages = _read_dump_dir(tmp_path)
+    assert len(manifest["files"]) == 1
+    assert len(messages) == 1
+
+
+def test_dump_checkpoint(datanommer_models, mock_config, mock_init, tmp_path):
+    checkpoint = tmp_path / "dump.state"
+    _add_daily_messages(3)
+
+    runner = CliRunner(mix_stderr=False)
+    args = ["--format", "ndjson", "--checkpoint", str(checkpoint)]
+    result = runner.invoke(datanommer.commands.dump, args)
+    assert result.exit_code == 0, result.stderr
+    assert len(result.stdout.splitlines()) == 3
+    last = m.session.scalars(select(m.Message).order_by(m.Message.timestamp.desc())).first()
+    assert json.loads(checkpoint.read_text()) == {
+        "timestamp": "2013-02-03T00:00:00",
+        "id": last.id,
+    }
+
+    # Only the new messages are dumped
+    result = runner.invoke(datanommer.commands.dump, args)
+    assert result.exit_code == 0, result.stderr
+    assert result.stdout == ""
+    msg = generate_message(topic="org.fedoraproject.prod.test.new")
+    msg._properties.headers["sent-at"] = datetime(2013, 2, 10).isoformat()
+    m.add(msg)
+    result = runner.invoke(datanommer.commands.dump, args)
+    assert result.exit_code == 0, result.stderr
+    assert [json.loads(line)["topic"] for line in result.stdout.splitlines()] == [
+        "org.fedoraproject.prod.test.new"
+    ]
+
+
+def test_dump_checkpoint_resume(datanommer_models, mock_config, mock_init, mocker, tmp_path):
+    checkpoint = tmp_path / "dump.state"
+    _add_daily_messages(5)
+    as_dict = m.Message.as_fedora_message_dict
+    calls = []
+
+    def crash_on_fourth(message):
+        # Only the first run crashes
+        calls.append(message)
+        if len(calls) == 4:
+            raise RuntimeError("crash")
+        return as_dict(message)
+
+    runner = CliRunner(mix_stderr=False)
+    args = ["--format", "ndjson", "--checkpoint", str(checkpoint), "--chunk-size", "2"]
+    mocker.patch.object(m.Message, "as_fedora_message_dict", crash_on_fourth)
+    result = runner.invoke(datanommer.commands.dump, args)
+    assert result.exit_code == 1
+    assert len(result.stdout.splitlines()) == 3
+    assert json.loads(checkpoint.read_text())["timestamp"] == "2013-02-02T00:00:00"
+
+    # The last chunk is dumped again
+    result = runner.invoke(datanommer.commands.dump, args)
+    assert result.exit_code == 0, result.stderr
+    assert [json.loads(line)["topic"] for line in result.stdout.splitlines()] == [
+        f"org.fedoraproject.prod.test.{day}" for day in range(3, 6)
+    ]
+
+
+def test_dump_checkpoint_recent(datanommer_models, mock_config, mock_init, tmp_path):
+    m.add(generate_message())
+    runner = CliRunner(mix_stderr=False)
+    args = ["--format", "ndjson", "--checkpoint", str(tmp_path / "dump.state")]
+    result = runner.invoke(datanommer.commands.dump, args)
+    assert result.exit_code == 0, result.stderr
+    assert result.stdout == ""
+    assert not (tmp_path / "dump.state").exists()
+
+    # Unless --before is used
+    future = (datetime.now() + timedelta(days=1)).isoformat()
+    result = runner.invoke(datanommer.commands.dump, [*args, "--before", future])
+    assert result.exit_code == 0, result.stderr
+    assert len(result.stdout.splitlines()) == 1
+
+
+def test_dump_checkpoint_invalid(datanommer_models, mock_config, mock_init, tmp_path):
+    checkpoint = tmp_path / "dump.state"
+    checkpoint.write_text("not json")
+    runner = CliRunner()
+    result = runner.invoke(
+        datanommer.commands.dump, ["--format", "ndjson", "--checkpoint", str(checkpoint)]
+    )
+    assert result.exit_code == 1
+    assert f"Invalid checkpoint file: {checkpoint}" in result.output
+
+    result = runner.invoke(datanommer.commands.dump, ["--checkpoint", str(checkpoint)])
+    assert result.exit_code == 2
+    assert "--checkpoint requires --format ndjson" in result.output
+
+
 def test_dump_invalid_dates(datanommer_models, mock_config, mock_init):
     runner = CliRunner()
     result = runner.invoke(datanommer.commands.dump, ["--before", "2013-02-16asdasd"])
@@ -0,0 +1,178 @@
+import json
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+from sqlalchemy import func, select, text
+
+import datanommer.commands
+import datanommer.models as m
+from datanommer.commands.load import load_tables
+from datanommer.commands.load import main as load
+
+from .utils import generate_bodhi_update_complete_message, generate_message
+
+
+def _clear_database():
+    for table in reversed(m.DeclarativeBase.metadata.sorted_tables):
+        m.session.execute(table.delete())
+    m.session.commit()
+    m.User.clear_cache()
+    m.Package.clear_cache()
+
+
+def _describe(message):
+    return (
+        message.topic,
+        message.timestamp,
+        message.msg,
+        sorted(user.name for user in message.users),
+        sorted(package.name for package in message.packages),
+    )
+
+
+def _count(table):
+    return m.session.scalar(select(func.count()).select_from(table))
+
+
+@pytest.mark.parametrize("copy_format", ["binary", "csv"])
+def test_dump_and_load(datanommer_models, mock_config, mock_init, tmp_path, copy_format):
+    messages = [generate_bodhi_update_complete_message(), generate_message()]
+    for message in messages:
+        m.add(message)
+    expected = {message.id: _describe(m.Message.from_msg_id(message.id)) for message in messages}
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--copy", copy_format])
+    assert result.exit_code == 0, result.stderr
+    assert "Copied 2 rows from messages" in result.stderr
+
+    _clear_database()
+    # Add some rows first so that the ids have to be remapped
+    m.User.get_or_create("someone-else")
+    m.Package.get_or_create("another-package")
+    m.add(generate_message())
+    m.session.commit()
+
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 0, result.stderr
+    assert result.stdout == "Loaded 2 messages, skipped 0 already in the database\n"
+    for msg_id, description in expected.items():
+        assert _describe(m.Message.from_msg_id(msg_id)) == description
+    assert _count(m.Message.__table__) == 3
+
+    # Loading again skips the messages
+    assoc_count = _count(m.users_assoc_table)
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 0, result.stderr
+    assert result.stdout == "Loaded 0 messages, skipped 2 already in the database\n"
+    assert _count(m.Message.__table__) == 3
+    assert _count(m.users_assoc_table) == assoc_count
+
+
+def test_load_column_order(datanommer_models, mock_config, mock_init, tmp_path):
+    message = generate_bodhi_update_complete_message()
+    m.add(message)
+    expected = _describe(m.Message.from_msg_id(message.id))
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--copy", "binary"])
+    assert result.exit_code == 0, result.stderr
+    with open(tmp_path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    _clear_database()
+    # The migration to JSONB put the msg column last, after the headers column. This is
+    # rolled back at the end of the test.
+    m.session.execute(text("ALTER TABLE messages DROP COLUMN msg"))
+    m.session.execute(text("ALTER TABLE messages ADD COLUMN msg jsonb NOT NULL"))
+    assert load_tables(tmp_path, manifest) == (1, 0)
+    assert _describe(m.Message.from_msg_id(message.id)) == expected
+    m.session.rollback()
+
+
+def test_load_unknown_columns(datanommer_models, mock_config, mock_init, tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--copy", "csv"])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest["files"][0]["columns"].append("id); DROP TABLE users; --")
+    with open(tmp_path / "manifest.json", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 1
+    assert "The columns of the users table don't match" in result.output
+
+
+def test_dump_copy_timespan(datanommer_models, mock_config, mock_init, tmp_path):
+    for day in (1, 2, 3):
+        message = generate_bodhi_update_complete_message()
+        message._properties.headers["sent-at"] = datetime(2013, 2, day).isoformat()
+        m.add(message)
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(
+        datanommer.commands.dump,
+        [
+            "-o",
+            str(tmp_path),
+            "--copy",
+            "binary",
+            "--since",
+            "2013-02-02",
+            "--before",
+            "2013-02-02",
+        ],
+    )
+    assert result.exit_code == 0, result.stderr
+    with open(tmp_path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    rows = {copied_file["table"]: copied_file["rows"] for copied_file in manifest["files"]}
+    assert rows["messages"] == 1
+    assert rows["users_messages"] == _count(m.users_assoc_table) / 3
+    assert rows["packages"] == _count(m.Package.__table__)
+
+    _clear_database()
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 0, result.stderr
+    assert m.session.scalar(select(m.Message.timestamp)) == datetime(2013, 2, 2)
+
+
+def test_dump_copy_without_output_dir(datanommer_models, mock_config, mock_init):
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.dump, ["--copy", "binary"])
+    assert result.exit_code == 2
+    assert "--copy requires --output-dir" in result.output
+
+
+def test_load_no_manifest(datanommer_models, mock_config, mock_init, tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 1
+    assert "does not contain a manifest.json file" in result.output
+
+
+def test_load_not_a_copy_dump(datanommer_models, mock_config, mock_init, tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path)])
+    assert result.exit_code == 0, result.output
+
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 1
+    assert "does not contain a COPY dump" in result.output
+
+
+def test_load_missing_table(datanommer_models, mock_config, mock_init, tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(datanommer.commands.dump, ["-o", str(tmp_path), "--copy", "csv"])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest["files"] = [f for f in manifest["files"] if f["table"] != "packages_messages"]
+    with open(tmp_path / "manifest.json", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    result = runner.invoke(load, [str(tmp_path)])
+    assert result.exit_code == 1
+    assert "The packages_messages table is missing from the dump" in result.output
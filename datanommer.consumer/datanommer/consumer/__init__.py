@@ -13,10 +13,18 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import atexit
 import importlib.metadata
 import logging
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from fedora_messaging import config
+from sqlalchemy.exc import InterfaceError, OperationalError
 
 import datanommer.models as m
 
@@ -33,17 +41,219 @@ def get_datanommer_sqlalchemy_url():
         ) from e
 
 
+def get_batch_config():
+    """Return the batch size and the batch timeout (in seconds)."""
+    consumer_config = config.conf["consumer_config"]
+    return (
+        int(consumer_config.get("datanommer_batch_size", 1)),
+        float(consumer_config.get("datanommer_batch_timeout", 1.0)),
+    )
+
+
 log = logging.getLogger("datanommer-consumer")
 
 
+class WorkerPool:
+    """A pool of processes that store messages in the database.
+
+    Each worker process has its own database engine, session and caches, and the
+    messages are spread across the workers. This moves the message validation and
+    serialization off the consumer's process.
+
+    If a worker process dies, the pool is broken: it is replaced with a new one, and
+    the error is raised for the current messages.
+    """
+
+    def __init__(self, workers, url, cache_size=None, cache_ttl=None):
+        self.workers = workers
+        self._initargs = (url, cache_size, cache_ttl)
+        self._executor = self._start()
+
+    def _start(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            # Don't fork the consumer's threads
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    def add_many(self, messages):
+        """Store the messages using all the workers.
+
+        Wait until all the workers are done, and raise the first error if any.
+        """
+        if not messages:
+            return
+        chunk_size = math.ceil(len(messages) / self.workers)
+        try:
+            futures = [
+                self._executor.submit(_add_many, messages[index : index + chunk_size])
+                for index in range(0, len(messages), chunk_size)
+            ]
+            wait(futures)
+            for future in futures:
+                future.result()
+        except BrokenProcessPool:
+            log.warning("A worker process died, starting new ones")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start()
+            raise
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+def _init_worker(url, cache_size, cache_ttl):
+    m.init(url, cache_size=cache_size, cache_ttl=cache_ttl, warm_cache=True)
+
+
+def _add_many(messages):
+    try:
+        m.add_many(messages)
+    except Exception:
+        m.session.rollback()
+        raise
+
+
 class Nommer:
+    """Store the consumed messages in the database.
+
+    By default each message is committed as soon as it is received. If the
+    ``datanommer_batch_size`` configuration value is greater than 1, messages are
+    accumulated and written in a single transaction when the batch is full, or when
+    the oldest message in the batch has been waiting for more than
+    ``datanommer_batch_timeout`` seconds.
+
+    In batch mode, setting ``datanommer_workers`` to more than 1 spreads each batch
+    across that many worker processes. A batch is only considered written when all
+    the workers have succeeded.
+
+    If a batch can't be written, its messages are stored one at a time, and the ones
+    that still fail are logged and dropped, so that an invalid message does not take
+    the rest of the batch with it. If the database can't be reached, the error is
+    raised and the batch is kept.
+
+    Note that fedora-messaging acknowledges each message as soon as this callback
+    returns, so in batch mode up to ``datanommer_batch_size - 1`` acknowledged
+    messages only live in memory until the batch is flushed. An error raised from
+    this callback makes fedora-messaging stop the consumer, and the pending batch is
+    then flushed one last time when the process exits. If that fails too, or if the
+    process is killed, those messages are lost. This is why batching is off by
+    default.
+    """
+
     def __init__(self):
-        m.init(get_datanommer_sqlalchemy_url())
+        url = get_datanommer_sqlalchemy_url()
+        consumer_config = config.conf["consumer_config"]
+        cache_size = consumer_config.get("datanommer_cache_size")
+        cache_ttl = consumer_config.get("datanommer_cache_ttl")
+        self.batch_size, self.batch_timeout = get_batch_config()
+        workers = int(consumer_config.get("datanommer_workers", 1))
+        self._pool = None
+        if self.batch_size > 1 and workers > 1:
+            self._pool = WorkerPool(workers, url, cache_size=cache_size, cache_ttl=cache_ttl)
+        m.init(
+            url,
+            cache_size=cache_size,
+            cache_ttl=cache_ttl,
+            # The workers have their own caches
+            warm_cache=self._pool is None,
+        )
+        self._batch = []
+        self._batch_started = None
+        self._lock = threading.RLock()
+        self._timer = None
+        if self.batch_size > 1:
+            atexit.register(self.close)
 
     def __call__(self, message):
         log.info("Nomming %r", message)
+        if self.batch_size <= 1:
+            try:
+                m.add(message)
+            except Exception:
+                m.session.rollback()
+                raise
+            return
+
+        with self._lock:
+            if not self._batch:
+                self._batch_started = time.monotonic()
+                self._start_timer()
+            self._batch.append(message)
+            if (
+                len(self._batch) >= self.batch_size
+                or time.monotonic() - self._batch_started >= self.batch_timeout
+            ):
+                self.flush()
+
+    def flush(self):
+        """Write the pending batch of messages to the database."""
+        with self._lock:
+            self._cancel_timer()
+            if not self._batch:
+                return
+            log.debug("Flushing a batch of %s messages", len(self._batch))
+            try:
+                if self._pool is None:
+                    m.add_many(self._batch)
+                else:
+                    self._pool.add_many(self._batch)
+            except Exception:
+                m.session.rollback()
+                log.exception(
+                    "Could not store a batch of %s messages, storing them one at a time",
+                    len(self._batch),
+                )
+                self._add_one_by_one(self._batch)
+            self._batch = []
+            self._batch_started = None
+
+    def _add_one_by_one(self, messages):
+        # The messages that were already stored by a worker are skipped as duplicates.
+        for message in messages:
+            try:
+                m.add(message)
+            except (OperationalError, InterfaceError):
+                # The database is unavailable, the batch will be retried.
+                m.session.rollback()
+                raise
+            except Exception:
+                m.session.rollback()
+                log.exception(
+                    "Could not store the message from %s with id %s, dropping it",
+                    message.topic,
+                    message.id,
+                )
+
+    def close(self):
+        """Stop the worker processes and flush the pending batch."""
+        # The process pool can't be used while the interpreter exits, write the last
+        # batch from this process.
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+        self.flush()
+
+    def _start_timer(self):
+        self._timer = threading.Timer(self.batch_timeout, self._flush_on_timeout)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_on_timeout(self):
         try:
-            m.add(message)
+            self.flush()
         except Exception:
-            m.session.rollback()
-            raise
+            log.exception("Could not flush the batch of messages, will retry later")
+            with self._lock:
+                if self._batch and self._timer is None:
+                    self._start_timer()
+        finally:
+            # This thread's session won't be used again.
+            m.session.remove()
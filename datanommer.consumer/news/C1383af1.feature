@@ -0,0 +1,3 @@
+Add an optional batch mode, enabled with the ``datanommer_batch_size`` and
+``datanommer_batch_timeout`` settings. The messages of a batch that can't be stored
+are retried one at a time
@@ -0,0 +1,2 @@
+Add the ``datanommer_cache_size`` and ``datanommer_cache_ttl`` settings for the
+user and package caches
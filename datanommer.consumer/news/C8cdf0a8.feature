@@ -0,0 +1,2 @@
+Spread the batches across ``datanommer_workers`` worker processes. A worker process
+that dies is replaced
@@ -14,9 +14,14 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+
 import pytest
 from fedora_messaging import message
 from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
 
 import datanommer.consumer
 import datanommer.models as dm
@@ -40,17 +45,228 @@ def test_consume(datanommer_models, consumer):
     assert dm.session.scalar(select(func.count(dm.Message.id))) == 1
 
 
+def test_init_cache_config(mocker):
+    mocker.patch("datanommer.consumer.get_datanommer_sqlalchemy_url", return_value="TESTURL")
+    mocker.patch.dict(
+        datanommer.consumer.config.conf["consumer_config"],
+        {"datanommer_cache_size": 1000, "datanommer_cache_ttl": 3600},
+    )
+    mock_init = mocker.patch("datanommer.consumer.m.init")
+    datanommer.consumer.Nommer()
+    mock_init.assert_called_once_with("TESTURL", cache_size=1000, cache_ttl=3600, warm_cache=True)
+
+
 def test_add_exception(datanommer_models, consumer, mocker):
     example_message = message.Message(
         topic="nice.message", body={"encouragement": "You're doing great!"}
     )
 
-    dm.add = mocker.Mock(side_effect=RuntimeError("an exception"))
+    mocker.patch.object(dm, "add", side_effect=RuntimeError("an exception"))
     consumer = datanommer.consumer.Nommer()
     with pytest.raises(RuntimeError):
         consumer(example_message)
 
 
+@pytest.fixture
+def batch_consumer(mocker):
+    mock_get_url = mocker.patch("datanommer.consumer.get_datanommer_sqlalchemy_url")
+    mock_get_url.return_value = "sqlite:///fake.db"
+    mocker.patch("datanommer.consumer.get_batch_config", return_value=(3, 60))
+    mocker.patch("datanommer.consumer.atexit.register")
+    consumer = datanommer.consumer.Nommer()
+    yield consumer
+    consumer._cancel_timer()
+
+
+def _count_messages():
+    return dm.session.scalar(select(func.count(dm.Message.id)))
+
+
+def _generate_messages(count):
+    messages = []
+    for x in range(count):
+        example_message = message.Message(
+            topic="nice.message", body={"encouragement": "You're doing great!"}
+        )
+        example_message.id = f"{x}"
+        messages.append(example_message)
+    return messages
+
+
+def test_consume_batch(datanommer_models, batch_consumer):
+    messages = _generate_messages(4)
+    batch_consumer(messages[0])
+    batch_consumer(messages[1])
+    assert _count_messages() == 0
+    batch_consumer(messages[2])
+    assert _count_messages() == 3
+    batch_consumer(messages[3])
+    assert _count_messages() == 3
+    assert batch_consumer._batch == [messages[3]]
+
+
+def test_consume_batch_timeout(datanommer_models, batch_consumer):
+    messages = _generate_messages(2)
+    batch_consumer(messages[0])
+    assert batch_consumer._timer is not None
+    batch_consumer._batch_started -= 60
+    batch_consumer(messages[1])
+    assert _count_messages() == 2
+    assert batch_consumer._timer is None
+
+
+def test_consume_batch_timer(datanommer_models, batch_consumer):
+    batch_consumer(_generate_messages(1)[0])
+    assert _count_messages() == 0
+    batch_consumer._flush_on_timeout()
+    assert _count_messages() == 1
+    assert batch_consumer._batch == []
+
+
+def _database_error():
+    return OperationalError("INSERT", {}, Exception("connection refused"))
+
+
+def test_consume_batch_timer_error(datanommer_models, batch_consumer, mocker, caplog):
+    mocker.patch.object(dm, "add_many", side_effect=_database_error())
+    mocker.patch.object(dm, "add", side_effect=_database_error())
+    example_message = _generate_messages(1)[0]
+    batch_consumer(example_message)
+    batch_consumer._cancel_timer()
+    batch_consumer._flush_on_timeout()
+    assert "Could not flush the batch of messages" in caplog.records[-1].message
+    # The batch is kept and will be retried
+    assert batch_consumer._batch == [example_message]
+    assert batch_consumer._timer is not None
+
+
+def test_consume_batch_error(datanommer_models, batch_consumer, mocker):
+    mocker.patch.object(dm, "add_many", side_effect=_database_error())
+    mocker.patch.object(dm, "add", side_effect=_database_error())
+    messages = _generate_messages(3)
+    batch_consumer(messages[0])
+    batch_consumer(messages[1])
+    with pytest.raises(OperationalError):
+        batch_consumer(messages[2])
+    assert batch_consumer._batch == messages
+
+
+def test_consume_batch_invalid_message(datanommer_models, batch_consumer, caplog):
+    messages = _generate_messages(3)
+    # This one can't be stored
+    messages[1].topic = None
+    for example_message in messages:
+        batch_consumer(example_message)
+    assert batch_consumer._batch == []
+    assert dm.session.scalars(select(dm.Message.msg_id).order_by(dm.Message.msg_id)).all() == [
+        "0",
+        "2",
+    ]
+    assert "Could not store a batch of 3 messages" in caplog.text
+    assert "Could not store the message from None with id 1, dropping it" in caplog.text
+
+
+def test_flush_empty(datanommer_models, batch_consumer, mocker):
+    add_many = mocker.patch.object(dm, "add_many")
+    batch_consumer.flush()
+    add_many.assert_not_called()
+
+
+def test_worker_pool(datanommer_models, datanommer_db_url):
+    pool = datanommer.consumer.WorkerPool(2, datanommer_db_url)
+    try:
+        pool.add_many(_generate_messages(5))
+        pool.add_many([])
+    finally:
+        pool.shutdown()
+    assert _count_messages() == 5
+
+
+def test_worker_pool_error(datanommer_models, datanommer_db_url):
+    messages = _generate_messages(4)
+    messages[3].topic = None
+    pool = datanommer.consumer.WorkerPool(2, datanommer_db_url)
+    try:
+        with pytest.raises(TypeError):
+            pool.add_many(messages)
+    finally:
+        pool.shutdown()
+    # The other worker's messages were written
+    assert _count_messages() == 2
+
+
+def test_worker_pool_broken(datanommer_models, datanommer_db_url, caplog):
+    pool = datanommer.consumer.WorkerPool(2, datanommer_db_url)
+    try:
+        # Kill a worker process
+        wait([pool._executor.submit(os._exit, 1)])
+        with pytest.raises(BrokenProcessPool):
+            pool.add_many(_generate_messages(2))
+        assert "A worker process died, starting new ones" in caplog.text
+        # The next messages are stored by new workers
+        pool.add_many(_generate_messages(3))
+    finally:
+        pool.shutdown()
+    assert _count_messages() == 3
+
+
+def test_worker_functions(datanommer_models, mocker):
+    # These run in the worker processes, test them here too.
+    mock_init = mocker.patch("datanommer.consumer.m.init")
+    datanommer.consumer._init_worker("TESTURL", 10, 60)
+    mock_init.assert_called_once_with("TESTURL", cache_size=10, cache_ttl=60, warm_cache=True)
+
+    datanommer.consumer._add_many(_generate_messages(2))
+    assert _count_messages() == 2
+
+    mocker.patch.object(dm, "add_many", side_effect=RuntimeError("an exception"))
+    rollback = mocker.spy(dm.session, "rollback")
+    with pytest.raises(RuntimeError):
+        datanommer.consumer._add_many(_generate_messages(1))
+    rollback.assert_called_once_with()
+
+
+def test_close_without_pool(datanommer_models, batch_consumer):
+    batch_consumer(_generate_messages(1)[0])
+    batch_consumer.close()
+    assert _count_messages() == 1
+
+
+def test_consume_batch_pool(datanommer_models, mocker):
+    mocker.patch("datanommer.consumer.get_datanommer_sqlalchemy_url", return_value="TESTURL")
+    mocker.patch("datanommer.consumer.get_batch_config", return_value=(2, 60))
+    mocker.patch.dict(datanommer.consumer.config.conf["consumer_config"], {"datanommer_workers": 4})
+    mocker.patch("datanommer.consumer.atexit.register")
+    mock_init = mocker.patch("datanommer.consumer.m.init")
+    mock_pool_class = mocker.patch("datanommer.consumer.WorkerPool")
+    pool = mock_pool_class.return_value
+    consumer = datanommer.consumer.Nommer()
+    mock_pool_class.assert_called_once_with(4, "TESTURL", cache_size=None, cache_ttl=None)
+    assert mock_init.call_args.kwargs["warm_cache"] is False
+
+    messages = _generate_messages(3)
+    consumer(messages[0])
+    consumer(messages[1])
+    pool.add_many.assert_called_once_with(messages[:2])
+
+    # On close, the pool is stopped and the last batch is written by this process
+    consumer(messages[2])
+    consumer.close()
+    pool.shutdown.assert_called_once_with()
+    pool.add_many.assert_called_once()
+    assert _count_messages() == 1
+
+
+def test_get_batch_config(mocker):
+    mocker.patch.dict(datanommer.consumer.config.conf["consumer_config"], {}, clear=True)
+    assert datanommer.consumer.get_batch_config() == (1, 1.0)
+    mocker.patch.dict(
+        datanommer.consumer.config.conf["consumer_config"],
+        {"datanommer_batch_size": 500, "datanommer_batch_timeout": 2},
+    )
+    assert datanommer.consumer.get_batch_config() == (500, 2.0)
+
+
 def test_get_datanommer_sqlalchemy_url_keyerror(mocker):
     mocker.patch.dict(
         datanommer.consumer.config.conf["consumer_config"],
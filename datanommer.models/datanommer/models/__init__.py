@@ -13,19 +13,29 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+import copy
 import datetime
+import hashlib
 import importlib.metadata
 import json
 import logging
 import math
+import threading
+import time
 import traceback
 import uuid
+from collections import OrderedDict
 from warnings import warn
 
 from sqlalchemy import (
     and_,
+    any_,
     between,
+    BigInteger,
+    cast,
     Column,
+    column,
     create_engine,
     DateTime,
     DDL,
@@ -33,36 +43,35 @@ from sqlalchemy import (
     ForeignKey,
     func,
     Index,
+    inspect,
     Integer,
+    literal,
     not_,
     or_,
     select,
-    String,
     Table,
+    table,
     text,
-    TypeDecorator,
+    tuple_,
     Unicode,
     UnicodeText,
     UniqueConstraint,
 )
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import (
+    attributes,
     declarative_base,
+    load_only,
+    make_transient_to_detached,
     relationship,
     scoped_session,
+    selectinload,
     sessionmaker,
     validates,
 )
-from sqlalchemy.sql import operators
-
-
-try:
-    from psycopg2.errors import UniqueViolation
-except ImportError:  # pragma: no cover
-    from psycopg2.errorcodes import lookup as lookup_error
-
-    UniqueViolation = lookup_error("23505")
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 
 __version__ = importlib.metadata.version("datanommer.models")
@@ -70,6 +79,11 @@ __version__ = importlib.metadata.version("datanommer.models")
 
 log = logging.getLogger("datanommer")
 
+# The default maximum number of names in the User and Package id caches
+DEFAULT_CACHE_SIZE = 10000
+# How far from the time hint Message.from_msg_id() searches
+TIME_HINT_MARGIN = datetime.timedelta(days=1)
+
 maker = sessionmaker()
 session = scoped_session(maker)
 
@@ -77,8 +91,30 @@ DeclarativeBase = declarative_base()
 DeclarativeBase.query = session.query_property()
 
 
-def init(uri=None, alembic_ini=None, engine=None, create=False):
-    """Initialize a connection.  Create tables if requested."""
+def init(
+    uri=None,
+    alembic_ini=None,
+    engine=None,
+    create=False,
+    cache_size=None,
+    cache_ttl=None,
+    warm_cache=False,
+    grep_cache=None,
+    default_window=None,
+    max_window=None,
+):
+    """Initialize a connection.  Create tables if requested.
+
+    The ``cache_size`` and ``cache_ttl`` arguments configure the caches of user and
+    package ids, and ``warm_cache`` pre-loads them from the database.
+
+    The ``grep_cache`` argument is an optional :class:`GrepCache` instance to cache
+    the results of :meth:`Message.grep`.
+
+    The ``default_window`` and ``max_window`` arguments are :class:`datetime.timedelta`
+    objects that limit the time range of the message queries, see
+    :meth:`Message.clamp_time_window`.
+    """
 
     if uri and engine:
         raise ValueError("uri and engine cannot both be specified")
@@ -100,9 +136,16 @@ def init(uri=None, alembic_ini=None, engine=None, create=False):
     maker.configure(bind=engine)
     DeclarativeBase.query = session.query_property()
 
+    for rel_class in (User, Package):
+        rel_class._cache.configure(max_size=cache_size, ttl=cache_ttl)
+    Message.grep_cache = grep_cache
+    Message.default_window = default_window
+    Message.max_window = max_window
+
     if create:
         with engine.begin() as connection:
             connection.execute(text("CREATE EXTENSION IF NOT EXISTS timescaledb"))
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
         DeclarativeBase.metadata.create_all(engine)
         # Loads the alembic configuration and generates the version table, with
         # the most recent revision stamped as head
@@ -113,11 +156,48 @@ def init(uri=None, alembic_ini=None, engine=None, create=False):
             alembic_cfg = Config(alembic_ini)
             command.stamp(alembic_cfg, "head")
 
+    if warm_cache:
+        for rel_class in (User, Package):
+            rel_class.warm_cache()
+
 
 def add(message):
     """Take a the fedora-messaging Message and store in the message
     table.
     """
+    values = _get_message_values(message)
+    if values is None:
+        return
+    Message.create(**values)
+    session.commit()
+    if Message.grep_cache is not None:
+        Message.grep_cache.invalidate([values["timestamp"]])
+
+
+def add_many(messages):
+    """Store a list of fedora-messaging Messages in a single transaction.
+
+    This is equivalent to calling :func:`add` on each message, but the database
+    transaction is only committed once, after all the messages have been inserted.
+
+    Messages that are already in the database are skipped, but any other error (an
+    ``IntegrityError`` or a ``DataError`` for example) aborts the whole transaction, and
+    none of the messages are stored. It is up to the caller to roll the session back
+    and to store the messages one at a time with :func:`add` to isolate the invalid
+    ones, like the consumer does.
+    """
+    values = [v for v in (_get_message_values(message) for message in messages) if v is not None]
+    Message.bulk_create(values)
+    session.commit()
+    if Message.grep_cache is not None:
+        Message.grep_cache.invalidate([v["timestamp"] for v in values])
+
+
+def _get_message_values(message):
+    """Extract the column values from a fedora-messaging Message.
+
+    Returns ``None`` if the message can't be stored.
+    """
     headers = message._properties.headers
     sent_at = headers.get("sent-at", None)
 
@@ -128,7 +208,7 @@ def add(message):
             sent_at = datetime.datetime.fromisoformat(sent_at.replace("Z", "+00:00"))
         except ValueError:
             log.exception("Failed to parse sent-at timestamp value")
-            return
+            return None
     else:
         sent_at = datetime.datetime.now(tz=datetime.timezone.utc)
 
@@ -152,7 +232,7 @@ def add(message):
         )
         packages = []
 
-    Message.create(
+    return dict(
         i=0,
         msg_id=message.id,
         topic=message.topic,
@@ -164,36 +244,22 @@ def add(message):
         packages=packages,
     )
 
-    session.commit()
-
-
-# https://docs.sqlalchemy.org/en/14/core/custom_types.html#marshal-json-strings
 
+# https://docs.sqlalchemy.org/en/20/core/compiler.html
 
-class _JSONEncodedDict(TypeDecorator):
-    """Represents an immutable structure as a json-encoded string."""
 
-    impl = UnicodeText
+class _Explain(Executable, ClauseElement):
+    """Get the query plan of a statement, with the planner's estimates."""
 
-    cache_ok = True
+    inherit_cache = False
 
-    def process_bind_param(self, value, dialect):
-        if value is not None:
-            value = json.dumps(value)
+    def __init__(self, statement):
+        self.statement = statement
 
-        return value
 
-    def process_result_value(self, value, dialect):
-        if value is not None:
-            value = json.loads(value)
-        return value
-
-    def coerce_compared_value(self, op, value):
-        # https://docs.sqlalchemy.org/en/14/core/custom_types.html#dealing-with-comparison-operations
-        if op in (operators.like_op, operators.not_like_op):
-            return String()
-        else:
-            return self
+@compiles(_Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
 
 
 users_assoc_table = Table(
@@ -212,6 +278,27 @@ packages_assoc_table = Table(
     Column("msg_timestamp", DateTime, primary_key=True, index=True),
 )
 
+# The messages table is partitioned on the timestamp, this table is not: it gives the
+# timestamp of a message from its id, to only read the right chunk of the messages table.
+message_ids_table = Table(
+    "message_ids",
+    DeclarativeBase.metadata,
+    Column("msg_id", Unicode, primary_key=True),
+    Column("timestamp", DateTime, nullable=False),
+)
+
+# Hourly message counts, maintained by TimescaleDB as a continuous aggregate of the
+# messages table (see below). The messages that are not materialized yet are counted
+# from the messages table when it is queried.
+messages_hourly = table(
+    "messages_hourly",
+    column("hour", DateTime),
+    column("category", Unicode),
+    column("topic", Unicode),
+    column("agent_name", Unicode),
+    column("messages", BigInteger),
+)
+
 
 class Message(DeclarativeBase):
     __tablename__ = "messages"
@@ -223,21 +310,27 @@ class Message(DeclarativeBase):
             postgresql_using="gin",
             postgresql_ops={"headers": "jsonb_path_ops"},
         ),
+        Index(
+            "ix_messages_msg",
+            "msg",
+            postgresql_using="gin",
+            postgresql_ops={"msg": "jsonb_path_ops"},
+        ),
     )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     msg_id = Column(Unicode, nullable=True, default=None, index=True)
     i = Column(Integer, nullable=False)
-    topic = Column(Unicode, nullable=False, index=True)
+    topic = Column(Unicode, nullable=False)
     timestamp = Column(DateTime, nullable=False, index=True, primary_key=True)
     certificate = Column(UnicodeText)
     signature = Column(UnicodeText)
-    category = Column(Unicode, nullable=False, index=True)
-    agent_name = Column(Unicode, index=True)
+    category = Column(Unicode, nullable=False)
+    agent_name = Column(Unicode)
     crypto = Column(UnicodeText)
     source_name = Column(Unicode, default="datanommer")
     source_version = Column(Unicode, default=lambda context: __version__)
-    msg = Column(_JSONEncodedDict, nullable=False)
+    msg = Column(postgresql.JSONB, nullable=False)
     headers = Column(postgresql.JSONB(none_as_null=True))
     users = relationship(
         "User",
@@ -258,6 +351,14 @@ class Message(DeclarativeBase):
         ),
     )
 
+    # The number of duplicate messages that have been skipped by this process
+    skipped_duplicates = 0
+    # A GrepCache instance, set by init()
+    grep_cache = None
+    # The limits of the time range of the queries, set by init()
+    default_window = None
+    max_window = None
+
     @validates("topic")
     def get_category(self, key, topic):
         """Update the category when the topic is set.
@@ -265,68 +366,167 @@ class Message(DeclarativeBase):
         The method seems... unnatural. But even zzzeek says it's OK to do it:
         https://stackoverflow.com/a/6442201
         """
+        self.category = self._category_from_topic(topic)
+        return topic
+
+    @staticmethod
+    def _category_from_topic(topic):
         index = 2 if "VirtualTopic" in topic else 3
         try:
-            self.category = topic.split(".")[index]
+            return topic.split(".")[index]
         except Exception:
             traceback.print_exc()
-            self.category = "Unclassified"
-        return topic
+            return "Unclassified"
 
     @classmethod
     def create(cls, **kwargs):
-        users = kwargs.pop("users")
-        packages = kwargs.pop("packages")
-        if not kwargs.get("msg_id"):
-            log.info("Message on %s was received without a msg_id", kwargs["topic"])
-            kwargs["msg_id"] = str(uuid.uuid4())
-        obj = cls(**kwargs)
+        """Insert a message, unless it is already in the database.
 
+        Returns ``True`` if the message has been inserted.
+        """
         try:
-            session.add(obj)
-            session.flush()
-        except IntegrityError as e:
-            if isinstance(e.orig, UniqueViolation):
-                log.warning(
-                    "Skipping message from %s with duplicate id: %s",
-                    kwargs["topic"],
-                    kwargs["msg_id"],
-                )
-            else:
-                log.exception(
-                    "Unknown Integrity Error: message %s with id %s",
-                    kwargs["topic"],
-                    kwargs["msg_id"],
-                )
+            return cls.bulk_create([kwargs]) == 1
+        except IntegrityError:
+            log.exception(
+                "Unknown Integrity Error: message %s with id %s",
+                kwargs["topic"],
+                kwargs["msg_id"],
+            )
             session.rollback()
-            return
+            return False
+
+    @classmethod
+    def bulk_create(cls, messages):
+        """Insert many messages with a few set-based queries.
+
+        ``messages`` is a list of dicts with the same keys as the arguments of
+        :meth:`create`, and all the dicts must have the same keys. Duplicate messages
+        are skipped. Returns the number of inserted messages.
+
+        Unlike :meth:`create`, other errors are not handled per message: they are raised
+        and leave the transaction aborted for all the messages, see :func:`add_many`.
+        """
+        # Split the messages into groups where the msg_ids are unique, to be able to match
+        # the inserted rows with the values. There is usually only one group.
+        groups = []
+        for kwargs in messages:
+            kwargs = {key: _strip_nul(value) for key, value in kwargs.items()}
+            if not kwargs.get("msg_id"):
+                log.info("Message on %s was received without a msg_id", kwargs["topic"])
+                kwargs["msg_id"] = str(uuid.uuid4())
+            for group in groups:
+                if kwargs["msg_id"] not in group:
+                    break
+            else:
+                group = {}
+                groups.append(group)
+            group[kwargs["msg_id"]] = kwargs
+        return sum(cls._bulk_insert(group) for group in groups)
+
+    @classmethod
+    def _bulk_insert(cls, messages_by_id):
+        rows = []
+        for kwargs in messages_by_id.values():
+            row = {key: value for key, value in kwargs.items() if key not in ("users", "packages")}
+            row["category"] = cls._category_from_topic(row["topic"])
+            rows.append(row)
+        statement = (
+            postgresql.insert(cls.__table__)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["msg_id", "timestamp"])
+            .returning(cls.id, cls.msg_id, cls.timestamp)
+        )
+        inserted = session.execute(statement).all()
+        if inserted:
+            session.execute(
+                postgresql.insert(message_ids_table)
+                .values([{"msg_id": row.msg_id, "timestamp": row.timestamp} for row in inserted])
+                .on_conflict_do_nothing(index_elements=["msg_id"])
+            )
 
-        obj._insert_list(User, users_assoc_table, users)
-        obj._insert_list(Package, packages_assoc_table, packages)
+        skipped = messages_by_id.keys() - {row.msg_id for row in inserted}
+        Message.skipped_duplicates += len(skipped)
+        for msg_id in skipped:
+            log.warning(
+                "Skipping message from %s with duplicate id: %s",
+                messages_by_id[msg_id]["topic"],
+                msg_id,
+            )
+
+        for rel_class, assoc_table, key in (
+            (User, users_assoc_table, "users"),
+            (Package, packages_assoc_table, "packages"),
+        ):
+            names_by_row = {row: set(messages_by_id[row.msg_id].get(key) or []) for row in inserted}
+            ids = rel_class.ensure_many(set().union(*names_by_row.values()))
+            assoc_col_name = assoc_table.c[0].name
+            insert_values = [
+                {
+                    assoc_col_name: ids[name],
+                    "msg_id": row.id,
+                    "msg_timestamp": row.timestamp,
+                }
+                for row, names in names_by_row.items()
+                for name in names
+            ]
+            if insert_values:
+                session.execute(assoc_table.insert(), insert_values)
+
+        return len(inserted)
 
     def _insert_list(self, rel_class, assoc_table, values):
         if not values:
             return
         assoc_col_name = assoc_table.c[0].name
-        insert_values = []
-        for name in set(values):
-            attr_obj = rel_class.get_or_create(name)
-            # This would normally be a simple "obj.[users|packages].append(name)" kind
-            # of statement, but here we drop down out of sqlalchemy's ORM and into the
-            # sql abstraction in order to gain a little performance boost.
-            insert_values.append(
-                {
-                    assoc_col_name: attr_obj.id,
-                    "msg_id": self.id,
-                    "msg_timestamp": self.timestamp,
-                }
-            )
+        ids = rel_class.ensure_many(values)
+        # This would normally be a simple "obj.[users|packages].append(name)" kind
+        # of statement, but here we drop down out of sqlalchemy's ORM and into the
+        # sql abstraction in order to gain a little performance boost.
+        insert_values = [
+            {
+                assoc_col_name: obj_id,
+                "msg_id": self.id,
+                "msg_timestamp": self.timestamp,
+            }
+            for obj_id in ids.values()
+        ]
         session.execute(assoc_table.insert(), insert_values)
         session.flush()
 
     @classmethod
-    def from_msg_id(cls, msg_id):
-        return session.execute(select(cls).where(cls.msg_id == msg_id)).scalar_one_or_none()
+    def from_msg_id(cls, msg_id, time_hint=None):
+        """Get a message from its id, or ``None`` if it is not in the database.
+
+        The timestamp of the message is read from the ``message_ids`` table so that only
+        one chunk of the messages table is searched. If the caller already knows roughly
+        when the message was sent, ``time_hint`` is searched first, within
+        ``TIME_HINT_MARGIN``.
+        """
+        messages = cls.from_msg_ids([msg_id], time_hint=time_hint)
+        return messages[0] if messages else None
+
+    @classmethod
+    def from_msg_ids(cls, msg_ids, time_hint=None):
+        """Get messages from their ids, in the same order.
+
+        The ids that are not in the database are skipped.
+        """
+        found = {}
+        missing = set(msg_ids)
+        if time_hint is not None and missing:
+            query = select(cls).where(
+                cls.msg_id == _any(missing),
+                between(cls.timestamp, time_hint - TIME_HINT_MARGIN, time_hint + TIME_HINT_MARGIN),
+            )
+            found.update((message.msg_id, message) for message in session.scalars(query))
+            missing.difference_update(found)
+        if missing:
+            timestamps = select(message_ids_table.c.msg_id, message_ids_table.c.timestamp).where(
+                message_ids_table.c.msg_id == _any(missing)
+            )
+            query = select(cls).where(tuple_(cls.msg_id, cls.timestamp).in_(timestamps))
+            found.update((message.msg_id, message) for message in session.scalars(query))
+        return [found[msg_id] for msg_id in msg_ids if msg_id in found]
 
     def as_dict(self, request=None):
         return dict(
@@ -396,6 +596,11 @@ class Message(DeclarativeBase):
         agents=None,
         not_agents=None,
         contains=None,
+        body_contains=None,
+        body_paths=None,
+        columns=None,
+        load_related=False,
+        report_clamped=False,
     ):
         """Flexible query interface for messages.
 
@@ -424,6 +629,26 @@ class Message(DeclarativeBase):
             (user == 'ralph') AND
             NOT (category == 'bodhi' OR category == 'wiki')
 
+        The ``contains`` filter does a substring search in the message bodies, it
+        uses the trigram index for strings of three characters or more.
+        The ``body_contains`` and ``body_paths`` filters use the index on the message
+        bodies: ``body_contains`` is a list of dicts that must be contained in the
+        body, and ``body_paths`` is a list of SQL/JSON path expressions that must
+        match in the body, for example ``'$.comment.user ? (@.name == "ralph")'``.
+
+        If ``columns`` is a list of column names, only those columns (and the
+        primary key) are selected. The other columns are deferred: they are loaded
+        from the database when they are accessed, one query each, so this is meant
+        for listings that don't need the message bodies.
+
+        If ``load_related`` is true, the users and packages of all the messages are
+        loaded with two additional queries, instead of two queries per message when
+        they are accessed, for example by :meth:`as_dict`.
+
+        If ``report_clamped`` is true, a ``(query, clamped)`` tuple is returned, where
+        ``clamped`` tells whether the time range was limited by
+        :meth:`clamp_time_window`.
+
         """
 
         users = users or []
@@ -437,16 +662,28 @@ class Message(DeclarativeBase):
         agents = agents or []
         not_agents = not_agents or []
         contains = contains or []
+        body_contains = body_contains or []
+        body_paths = body_paths or []
 
         Message = cls
         query = select(Message)
 
+        if columns:
+            unknown = set(columns) - set(Message.__table__.columns.keys())
+            if unknown:
+                raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+            query = query.options(load_only(*(getattr(Message, name) for name in columns)))
+
+        if load_related:
+            query = query.options(selectinload(Message.users), selectinload(Message.packages))
+
         # A little argument validation.  We could provide some defaults in
         # these mixed cases.. but instead we'll just leave it up to our caller.
         if (start is not None and end is None) or (end is not None and start is None):
             raise ValueError(
                 "Either both start and end must be specified or neither must be specified"
             )
+        start, end, clamped = cls.clamp_time_window(start, end)
 
         if start and end:
             query = query.where(between(Message.timestamp, start, end))
@@ -455,42 +692,112 @@ class Message(DeclarativeBase):
             query = query.where(Message.msg_id == msg_id)
 
         # Add the four positive filters as necessary
+        position = tuple_(Message.id, Message.timestamp)
         if users:
-            query = query.where(or_(*(Message.users.any(User.name == u) for u in users)))
+            query = query.where(
+                position.in_(cls._select_related(User, users_assoc_table, users, start, end))
+            )
 
         if packages:
-            query = query.where(or_(*(Message.packages.any(Package.name == p) for p in packages)))
+            query = query.where(
+                position.in_(
+                    cls._select_related(Package, packages_assoc_table, packages, start, end)
+                )
+            )
 
         if categories:
-            query = query.where(or_(*(Message.category == category for category in categories)))
+            query = query.where(_equals_any(Message.category, categories))
 
         if topics:
-            query = query.where(or_(*(Message.topic == topic for topic in topics)))
+            query = query.where(_equals_any(Message.topic, topics))
 
         if agents:
-            query = query.where(or_(*(Message.agent_name == agent for agent in agents)))
+            query = query.where(_equals_any(Message.agent_name, agents))
 
         if contains:
-            query = query.where(or_(*(Message.msg.like(f"%{contain}%") for contain in contains)))
+            query = query.where(
+                cast(Message.msg, UnicodeText).like(_any([f"%{value}%" for value in contains]))
+            )
+
+        if body_contains:
+            query = query.where(or_(*(Message.msg.contains(value) for value in body_contains)))
+
+        if body_paths:
+            query = query.where(or_(*(Message.msg.path_exists(path) for path in body_paths)))
 
         # And then the four negative filters as necessary
         if not_users:
-            query = query.where(not_(or_(*(Message.users.any(User.name == u) for u in not_users))))
+            query = query.where(
+                ~cls._select_related(User, users_assoc_table, not_users, start, end, True).exists()
+            )
 
         if not_packs:
             query = query.where(
-                not_(or_(*(Message.packages.any(Package.name == p) for p in not_packs)))
+                ~cls._select_related(
+                    Package, packages_assoc_table, not_packs, start, end, True
+                ).exists()
             )
 
         if not_cats:
-            query = query.where(not_(or_(*(Message.category == category for category in not_cats))))
+            query = query.where(not_(_equals_any(Message.category, not_cats)))
 
         if not_topics:
-            query = query.where(not_(or_(*(Message.topic == topic for topic in not_topics))))
+            query = query.where(not_(_equals_any(Message.topic, not_topics)))
 
         if not_agents:
-            query = query.where(not_(or_(*(Message.agent_name == agent for agent in not_agents))))
+            query = query.where(not_(_equals_any(Message.agent_name, not_agents)))
+
+        if report_clamped:
+            return query, clamped
+        return query
+
+    @classmethod
+    def clamp_time_window(cls, start, end):
+        """Apply the default and maximum time windows set in :func:`init`.
+
+        Queries without a time range get the last ``default_window`` of messages, or
+        the last ``max_window`` if there is no default. Longer time ranges are cut to
+        their last ``max_window``. This prevents a single query from scanning all
+        the chunks of the database.
+
+        Returns the new ``(start, end)`` and whether they were changed. The queries
+        call this method, pass them ``report_clamped=True`` to know if they did limit
+        the time range.
+        """
+        clamped = False
+        if start is None and end is None:
+            window = cls.default_window or cls.max_window
+            if window is None:
+                return start, end, clamped
+            # The timestamps in the database are naive, in UTC.
+            end = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+            start = end - window
+            clamped = True
+        if cls.max_window is not None and end - start > cls.max_window:
+            start = end - cls.max_window
+            clamped = True
+        if clamped:
+            log.info("The time range of the query was limited to %s - %s", start, end)
+        return start, end, clamped
+
+    @classmethod
+    def _select_related(cls, rel_class, assoc_table, names, start, end, correlate=False):
+        """Select the messages associated with any of these users or packages.
 
+        The names are resolved to ids first, so that the association table is searched
+        with a single condition, and within the requested time range. If ``correlate`` is
+        true, only the row of the message of the enclosing query is selected.
+        """
+        ids = list(rel_class.get_ids(names).values())
+        query = select(assoc_table.c.msg_id, assoc_table.c.msg_timestamp).where(
+            assoc_table.c[f"{rel_class.__name__.lower()}_id"] == _any(ids, Integer)
+        )
+        if start and end:
+            query = query.where(between(assoc_table.c.msg_timestamp, start, end))
+        if correlate:
+            query = query.where(
+                assoc_table.c.msg_id == cls.id, assoc_table.c.msg_timestamp == cls.timestamp
+            )
         return query
 
     @classmethod
@@ -501,6 +808,8 @@ class Message(DeclarativeBase):
         rows_per_page=100,
         order="asc",
         defer=False,
+        count="exact",
+        report_clamped=False,
         **kwargs,
     ):
         """Flexible query interface for messages.
@@ -534,32 +843,212 @@ class Message(DeclarativeBase):
 
         If the `defer` argument evaluates to True, the query won't actually
         be executed, but a SQLAlchemy query object returned instead.
+
+        Deep pages get slower and slower, use :meth:`grep_cursor` to go through
+        many pages of results.
+
+        The `count` argument sets how the total number of messages is computed:
+
+        - ``exact``: with a count query, which can be slow for broad filters.
+        - ``estimate``: from the estimate of the query planner, which depends on
+          the table statistics being up to date.
+        - ``none``: the total is not computed and is ``None``, and the number of
+          pages is the current page number, plus one if there is a next page.
+          If the query is deferred, the number of pages is ``None``.
+
+        If ``report_clamped`` is true, a fourth value tells whether the time range
+        was limited by :meth:`clamp_time_window`, for example to show that only the
+        recent messages were searched.
+
+        If a :class:`GrepCache` has been passed to :func:`init`, the results are
+        cached, unless the query is deferred.
         """
-        query = cls.make_query(**kwargs)
+        arguments = dict(kwargs, page=page, rows_per_page=rows_per_page, order=order, count=count)
+        if report_clamped:
+            arguments["report_clamped"] = True
+        if defer or cls.grep_cache is None:
+            return cls._grep(defer=defer, **arguments)
+
+        cached = cls.grep_cache.get(arguments)
+        if cached is not None:
+            total, pages, rows, *clamped = cached
+            return total, pages, [cls._from_cache(row) for row in rows], *clamped
+        total, pages, messages, *clamped = cls._grep(**arguments)
+        rows = [cls._to_cache(m) for m in messages]
+        cls.grep_cache.set(arguments, (total, pages, rows, *clamped))
+        return total, pages, messages, *clamped
+
+    @classmethod
+    def _grep(
+        cls, *, page, rows_per_page, order, count, defer=False, report_clamped=False, **kwargs
+    ):
+        if count not in ("exact", "estimate", "none"):
+            raise ValueError("The count must be one of exact, estimate or none")
+
+        query, clamped = cls.make_query(report_clamped=True, **kwargs)
+        extra = (clamped,) if report_clamped else ()
         # Finally, tag on our pagination arguments
         Message = cls
 
-        query_total = query.with_only_columns(func.count(Message.id))
+        query_unordered = query
         total = None
+        pages = None
         query = query.order_by(getattr(Message.timestamp, order)())
 
         if not rows_per_page:
             pages = 1
+        elif count == "none":
+            # Get one more message to know if there is a next page
+            limit = rows_per_page if defer else rows_per_page + 1
+            query = query.offset(rows_per_page * (page - 1)).limit(limit)
         else:
-            total = session.scalar(query_total)
+            total = cls.count_query(query_unordered, count)
             pages = int(math.ceil(total / float(rows_per_page)))
             query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
 
         if defer:
-            if total is None:
-                total = session.scalar(query_total)
-            return total, pages, query
+            if total is None and count != "none":
+                total = cls.count_query(query_unordered, count)
+            return total, pages, query, *extra
         else:
             # Execute!
             messages = session.scalars(query).all()
             if pages == 1:
                 total = len(messages)
-            return total, pages, messages
+            elif pages is None:
+                pages = page + 1 if len(messages) > rows_per_page else page
+                messages = messages[:rows_per_page]
+            return total, pages, messages, *extra
+
+    @classmethod
+    def _to_cache(cls, message):
+        # Only the loaded columns, the others are deferred. Copy the values, the message
+        # could be changed by the caller.
+        columns = cls.__table__.columns.keys()
+        loaded = inspect(message).dict
+        row = copy.deepcopy({key: value for key, value in loaded.items() if key in columns})
+        # The users and packages loaded with load_related
+        for key in ("users", "packages"):
+            if key in loaded:
+                row[key] = [[related.id, related.name] for related in loaded[key]]
+        return row
+
+    @classmethod
+    def _from_cache(cls, row):
+        # Copy the values, the message could be changed by the caller.
+        row = copy.deepcopy(row)
+        related = {key: row.pop(key) for key in ("users", "packages") if key in row}
+        message = cls(**row)
+        make_transient_to_detached(message)
+        message = session.merge(message, load=False)
+        for key, items in related.items():
+            rel_class = User if key == "users" else Package
+            objs = []
+            for obj_id, name in items:
+                obj = rel_class(id=obj_id, name=name)
+                make_transient_to_detached(obj)
+                objs.append(session.merge(obj, load=False))
+            attributes.set_committed_value(message, key, objs)
+        return message
+
+    @classmethod
+    def count_query(cls, query, count="exact"):
+        """Count the messages selected by the query.
+
+        The ``count`` argument is ``exact`` or ``estimate``, as for :meth:`grep`. The
+        estimate comes from the query planner and doesn't read the messages.
+        """
+        query = query.order_by(None)
+        if count == "exact":
+            return session.scalar(query.with_only_columns(func.count(cls.id)))
+        plan = session.scalar(_Explain(query))
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @classmethod
+    def grep_cursor(
+        cls, *, cursor=None, rows_per_page=100, order="asc", report_clamped=False, **kwargs
+    ):
+        """Get a page of messages matching the regular grep filters, using a cursor.
+
+        Instead of a page number, this method takes the cursor returned with the
+        previous page, so that getting a page does not require going through all
+        the previous ones. Pass no cursor to get the first page.
+
+        Returns a ``(messages, next_cursor)`` tuple. The next cursor is ``None``
+        when there are no more messages. It must be used with the same filters
+        and order. If ``report_clamped`` is true, a third value tells whether the
+        time range was limited by :meth:`clamp_time_window`.
+        """
+        Message = cls
+        query, clamped = cls.make_query(report_clamped=True, **kwargs)
+        if order not in ("asc", "desc"):
+            raise ValueError("The order must be either asc or desc")
+
+        if cursor is not None:
+            timestamp, id_ = cls._decode_cursor(cursor)
+            position = tuple_(Message.timestamp, Message.id)
+            if order == "asc":
+                query = query.where(
+                    Message.timestamp >= timestamp, position > tuple_(timestamp, id_)
+                )
+            else:
+                query = query.where(
+                    Message.timestamp <= timestamp, position < tuple_(timestamp, id_)
+                )
+
+        query = query.order_by(
+            getattr(Message.timestamp, order)(), getattr(Message.id, order)()
+        ).limit(rows_per_page + 1)
+        messages = session.scalars(query).all()
+
+        next_cursor = None
+        if len(messages) > rows_per_page:
+            messages = messages[:rows_per_page]
+            next_cursor = cls._encode_cursor(messages[-1])
+        if report_clamped:
+            return messages, next_cursor, clamped
+        return messages, next_cursor
+
+    @classmethod
+    def stream(cls, *, batch_size=1000, order="asc", **kwargs):
+        """Iterate over all the messages matching the regular grep filters.
+
+        The messages are fetched ``batch_size`` at a time with a server-side cursor, and
+        removed from the session once the next batch is fetched, so that going through
+        a large number of messages uses a constant amount of memory. Don't keep
+        references to them, they won't be able to load their deferred columns or their
+        relationships anymore.
+        """
+        query = cls.make_query(**kwargs).order_by(
+            getattr(cls.timestamp, order)(), getattr(cls.id, order)()
+        )
+        return cls.stream_query(query, batch_size=batch_size)
+
+    @classmethod
+    def stream_query(cls, query, *, batch_size=1000):
+        """Iterate over the messages selected by the query, like :meth:`stream`.
+
+        This is for queries that :meth:`make_query` can't build, they must be ordered
+        by the caller.
+        """
+        result = session.scalars(query.execution_options(yield_per=batch_size))
+        for messages in result.partitions():
+            yield from messages
+            for message in messages:
+                session.expunge(message)
+
+    @staticmethod
+    def _encode_cursor(message):
+        position = json.dumps([message.timestamp.isoformat(), message.id])
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            timestamp, id_ = json.loads(base64.urlsafe_b64decode(cursor))
+            return datetime.datetime.fromisoformat(timestamp), int(id_)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid cursor: {cursor!r}") from e
 
     @classmethod
     def get_first(cls, *, order="asc", **kwargs):
@@ -569,6 +1058,235 @@ class Message(DeclarativeBase):
         return session.scalars(query).first()
 
 
+# The most common queries are for the latest messages of a topic, category or agent.
+Index("ix_messages_topic_timestamp", Message.topic, Message.timestamp.desc())
+Index("ix_messages_category_timestamp", Message.category, Message.timestamp.desc())
+Index("ix_messages_agent_name_timestamp", Message.agent_name, Message.timestamp.desc())
+Index(
+    "ix_users_messages_user_id_msg_timestamp",
+    users_assoc_table.c.user_id,
+    users_assoc_table.c.msg_timestamp.desc(),
+)
+Index(
+    "ix_packages_messages_package_id_msg_timestamp",
+    packages_assoc_table.c.package_id,
+    packages_assoc_table.c.msg_timestamp.desc(),
+)
+
+# Trigram index on the text of the message bodies. It is used by the ``contains`` filter
+# of Message.make_query(), which must cast the body to text the same way to match it.
+Index(
+    "ix_messages_msg_text",
+    cast(Message.msg, UnicodeText).label("msg_text"),
+    postgresql_using="gin",
+    postgresql_ops={"msg_text": "gin_trgm_ops"},
+)
+
+
+class CacheBackend:
+    """The interface of the backends of :class:`GrepCache`.
+
+    Implement it to store the results in a cache that is shared between processes,
+    such as memcached or redis. The values must then be serialized by the backend.
+    """
+
+    def get(self, key):
+        """Return the value for this key, or ``None`` if it is not cached."""
+
+    def set(self, key, value, ttl=None):
+        """Store a value, for ``ttl`` seconds or until it is evicted if ``ttl`` is None."""
+
+    def clear(self):
+        """Remove all the values."""
+
+
+class LRUCache(CacheBackend):
+    """A thread-safe LRU cache.
+
+    The cache is bounded in size, and entries can optionally expire after ``ttl``
+    seconds. It keeps count of the hits, misses and evictions.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def configure(self, max_size=None, ttl=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+                self._evict()
+            if ttl is not None:
+                self.ttl = ttl
+
+    def get(self, key):
+        """Return the value for this key, or ``None`` if it is not cached."""
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store a value, for ``ttl`` seconds or the cache's default."""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class GrepCache:
+    """Cache the results of :meth:`Message.grep`.
+
+    The results are stored in a :class:`CacheBackend`, by default an in-process
+    :class:`LRUCache` of ``max_size`` entries. They are keyed on the arguments of
+    the call, where the order of the values in the filters doesn't matter.
+
+    The results for a time range that ended more than ``settle_time`` ago are cached
+    until they are evicted: new messages don't change them. The other results expire
+    after ``ttl`` seconds, and they are invalidated when messages are added with
+    :func:`add` or :func:`add_many`. Adding a message older than ``settle_time``
+    invalidates all the results. Invalidation only reaches other processes, such as
+    the consumer, if they use the same shared backend.
+    """
+
+    def __init__(
+        self, backend=None, ttl=60, settle_time=datetime.timedelta(hours=1), max_size=1000
+    ):
+        self.backend = LRUCache(max_size=max_size) if backend is None else backend
+        self.ttl = ttl
+        self.settle_time = settle_time
+
+    def get(self, kwargs):
+        key, _closed = self._get_key(kwargs)
+        return self.backend.get(key)
+
+    def set(self, kwargs, value):
+        key, closed = self._get_key(kwargs)
+        self.backend.set(key, value, ttl=None if closed else self.ttl)
+
+    def invalidate(self, timestamps):
+        """Invalidate the results that messages with these timestamps can change."""
+        self._new_generation("recent")
+        settled = self._settled_before()
+        if any(_as_utc(timestamp) < settled for timestamp in timestamps):
+            self._new_generation("settled")
+
+    def _settled_before(self):
+        return datetime.datetime.now(tz=datetime.timezone.utc) - self.settle_time
+
+    def _get_key(self, kwargs):
+        end = kwargs.get("end")
+        closed = end is not None and _as_utc(end) < self._settled_before()
+        # Changing the generation makes the previous results unreachable.
+        generation = self._get_generation("settled")
+        if not closed:
+            generation += self._get_generation("recent")
+        arguments = {
+            name: (
+                sorted({json.dumps(item, sort_keys=True, default=str) for item in value})
+                if isinstance(value, list | tuple | set)
+                else value
+            )
+            for name, value in kwargs.items()
+            if value
+        }
+        digest = hashlib.sha256(
+            json.dumps([generation, arguments], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return f"datanommer:grep:{digest}", closed
+
+    def _get_generation(self, name):
+        generation = self.backend.get(f"datanommer:generation:{name}")
+        if generation is None:
+            generation = self._new_generation(name)
+        return generation
+
+    def _new_generation(self, name):
+        generation = uuid.uuid4().hex
+        self.backend.set(f"datanommer:generation:{name}", generation)
+        return generation
+
+
+def _any(values, item_type=UnicodeText):
+    """Compare to any of the values, passed as a single array parameter.
+
+    The SQL statement is then the same whatever the number of values, and so is its
+    compiled form in SQLAlchemy's cache.
+    """
+    return any_(literal(list(values), postgresql.ARRAY(item_type)))
+
+
+def _equals_any(column, values):
+    """Compare the column to any of the values.
+
+    A single value is compared with a plain equality, so that PostgreSQL can scan the
+    ``(column, timestamp)`` indexes in order and stop at the requested page. Otherwise,
+    this is :func:`_any`, with two SQL statements per filter in the cache.
+    """
+    values = list(values)
+    if len(values) == 1:
+        return column == values[0]
+    return column == _any(values)
+
+
+def _strip_nul(value):
+    # PostgreSQL doesn't support the NULL character in text or JSONB values, strip it like
+    # the migration to JSONB did.
+    if isinstance(value, str):
+        return value.replace("\x00", "")
+    if isinstance(value, dict):
+        return {_strip_nul(key): _strip_nul(item) for key, item in value.items()}
+    if isinstance(value, list | tuple | set):
+        return [_strip_nul(item) for item in value]
+    return value
+
+
+def _as_utc(timestamp):
+    # The timestamps in the database are naive, in UTC.
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
 class NamedSingleton:
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(UnicodeText, index=True, unique=True)
@@ -579,18 +1297,68 @@ class NamedSingleton:
         Return the instance of the class with the specified name. If it doesn't
         already exist, create it.
         """
-        # Use an in-memory cache to speed things up.
-        if name in cls._cache:
-            # If we cache the instance, SQLAlchemy will run this query anyway because the instance
-            # will be from a different transaction. So just cache the id.
-            return session.get(cls, cls._cache[name])
-        obj = session.execute(select(cls).where(cls.name == name)).scalar_one_or_none()
-        if obj is None:
-            obj = cls(name=name)
-            session.add(obj)
-            session.flush()
-        cls._cache[name] = obj.id
-        return obj
+        return session.get(cls, cls.ensure_many([name])[name])
+
+    @classmethod
+    def ensure_many(cls, names):
+        """Return a mapping of the names to their ids, creating the missing ones.
+
+        The names that are not in the cache are upserted in a single query, which is
+        safe when other processes create the same names concurrently.
+        """
+        ids = {}
+        missing = []
+        for name in set(names):
+            obj_id = cls._cache.get(name)
+            if obj_id is None:
+                missing.append(name)
+            else:
+                ids[name] = obj_id
+        if missing:
+            # Sort the names so that concurrent transactions lock the rows in the same order.
+            missing.sort()
+            statement = postgresql.insert(cls.__table__).values(
+                [{"name": name} for name in missing]
+            )
+            # Updating the conflicting rows is what makes them returned.
+            statement = statement.on_conflict_do_update(
+                index_elements=["name"], set_={"name": statement.excluded.name}
+            ).returning(cls.id, cls.name)
+            for obj_id, name in session.execute(statement):
+                cls._cache.set(name, obj_id)
+                ids[name] = obj_id
+        return ids
+
+    @classmethod
+    def get_ids(cls, names):
+        """Return a mapping of the names to their ids, ignoring the names that don't exist."""
+        ids = {}
+        missing = []
+        for name in set(names):
+            obj_id = cls._cache.get(name)
+            if obj_id is None:
+                missing.append(name)
+            else:
+                ids[name] = obj_id
+        if missing:
+            query = select(cls.id, cls.name).where(cls.name.in_(missing))
+            for obj_id, name in session.execute(query):
+                cls._cache.set(name, obj_id)
+                ids[name] = obj_id
+        return ids
+
+    @classmethod
+    def warm_cache(cls):
+        """Load the most recently created names into the cache."""
+        query = select(cls.id, cls.name).order_by(cls.id.desc()).limit(cls._cache.max_size)
+        with session.get_bind().connect() as connection:
+            rows = connection.execute(query).all()
+        for obj_id, name in reversed(rows):
+            cls._cache.set(name, obj_id)
+
+    @classmethod
+    def cache_stats(cls):
+        return cls._cache.stats()
 
     @classmethod
     def clear_cache(cls):
@@ -599,20 +1367,58 @@ class NamedSingleton:
 
 class User(DeclarativeBase, NamedSingleton):
     __tablename__ = "users"
-    _cache = {}
+    _cache = LRUCache()
 
 
 class Package(DeclarativeBase, NamedSingleton):
     __tablename__ = "packages"
-    _cache = {}
+    _cache = LRUCache()
 
 
-def _setup_hypertable(table_class):
+@event.listens_for(maker, "after_rollback")
+def _clear_caches_on_rollback(session):
+    # The cached ids of the names created in the rolled back transaction are now invalid.
+    User.clear_cache()
+    Package.clear_cache()
+
+
+def _setup_hypertable(table, time_column="timestamp", default_indexes=True):
     event.listen(
-        table_class.__table__,
+        table,
         "after_create",
-        DDL(f"SELECT create_hypertable('{table_class.__tablename__}', 'timestamp');"),
+        DDL(
+            f"SELECT create_hypertable('{table.name}', '{time_column}', "
+            f"create_default_indexes => {default_indexes});"
+        ),
     )
 
 
-_setup_hypertable(Message)
+_setup_hypertable(Message.__table__)
+# The association tables are partitioned like the messages, so that the user and package
+# filters only look in the chunks of the requested time range. Their time column is
+# already indexed.
+_setup_hypertable(users_assoc_table, "msg_timestamp", default_indexes=False)
+_setup_hypertable(packages_assoc_table, "msg_timestamp", default_indexes=False)
+
+event.listen(
+    Message.__table__,
+    "after_create",
+    DDL(
+        "CREATE MATERIALIZED VIEW messages_hourly "
+        "WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS "
+        "SELECT time_bucket(INTERVAL '1 hour', timestamp) AS hour, "
+        "category, topic, agent_name, count(*) AS messages "
+        "FROM messages GROUP BY hour, category, topic, agent_name "
+        "WITH NO DATA"
+    ),
+)
+# Refresh everything that changed, except the last hour that is still being filled.
+event.listen(
+    Message.__table__,
+    "after_create",
+    DDL(
+        "SELECT add_continuous_aggregate_policy('messages_hourly', "
+        "start_offset => NULL, end_offset => INTERVAL '1 hour', "
+        "schedule_interval => INTERVAL '1 hour')"
+    ),
+)
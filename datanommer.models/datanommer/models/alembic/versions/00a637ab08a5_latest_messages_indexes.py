@@ -0,0 +1,48 @@
+"""Indexes for the latest messages of a topic, category, agent, user or package
+
+Revision ID: 00a637ab08a5
+Revises: 2c18d158e327
+Create Date: 2026-10-18 22:14:52.731026
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "00a637ab08a5"
+down_revision = "2c18d158e327"
+
+
+def upgrade():
+    # The new indexes make the single-column indexes on topic, category and agent_name
+    # redundant.
+    for column in ("topic", "category", "agent_name"):
+        op.create_index(
+            f"ix_messages_{column}_timestamp",
+            "messages",
+            [column, sa.text("timestamp DESC")],
+            unique=False,
+        )
+        op.drop_index(f"ix_messages_{column}", table_name="messages")
+    op.create_index(
+        "ix_users_messages_user_id_msg_timestamp",
+        "users_messages",
+        ["user_id", sa.text("msg_timestamp DESC")],
+        unique=False,
+    )
+    op.create_index(
+        "ix_packages_messages_package_id_msg_timestamp",
+        "packages_messages",
+        ["package_id", sa.text("msg_timestamp DESC")],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_packages_messages_package_id_msg_timestamp", table_name="packages_messages")
+    op.drop_index("ix_users_messages_user_id_msg_timestamp", table_name="users_messages")
+    for column in ("topic", "category", "agent_name"):
+        op.create_index(f"ix_messages_{column}", "messages", [column], unique=False)
+        op.drop_index(f"ix_messages_{column}_timestamp", table_name="messages")
@@ -0,0 +1,30 @@
+"""Trigram index on the message bodies
+
+Revision ID: 13fde4c7d258
+Revises: be823a76bd6f
+Create Date: 2026-10-18 21:02:17.486215
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "13fde4c7d258"
+down_revision = "be823a76bd6f"
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        "ix_messages_msg_text",
+        "messages",
+        [sa.text("CAST(msg AS TEXT) gin_trgm_ops")],
+        unique=False,
+        postgresql_using="gin",
+    )
+
+
+def downgrade():
+    op.drop_index("ix_messages_msg_text", table_name="messages", postgresql_using="gin")
@@ -0,0 +1,52 @@
+"""Convert the association tables to hypertables
+
+Revision ID: 2c18d158e327
+Revises: 13fde4c7d258
+Create Date: 2026-10-18 21:47:35.120384
+
+The existing rows are moved to chunks during the upgrade, which locks the tables and takes
+a while on a large database: stop the consumer before upgrading.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "2c18d158e327"
+down_revision = "13fde4c7d258"
+
+
+def upgrade():
+    # The msg_timestamp columns are already indexed.
+    op.execute(
+        "SELECT create_hypertable('users_messages', 'msg_timestamp', "
+        "create_default_indexes => false, migrate_data => true)"
+    )
+    op.execute(
+        "SELECT create_hypertable('packages_messages', 'msg_timestamp', "
+        "create_default_indexes => false, migrate_data => true)"
+    )
+
+
+def _to_regular_table(table_name, id_column, related_table):
+    # Hypertables can't be converted back, copy the rows to a new regular table.
+    op.execute(f"CREATE TABLE {table_name}_backup AS TABLE {table_name}")
+    op.drop_table(table_name)
+    op.create_table(
+        table_name,
+        sa.Column(id_column, sa.Integer(), nullable=False),
+        sa.Column("msg_id", sa.Integer(), nullable=False),
+        sa.Column("msg_timestamp", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint([id_column], [f"{related_table}.id"]),
+        sa.PrimaryKeyConstraint(id_column, "msg_id", "msg_timestamp"),
+    )
+    op.create_index(op.f(f"ix_{table_name}_msg_id"), table_name, ["msg_id"])
+    op.create_index(op.f(f"ix_{table_name}_msg_timestamp"), table_name, ["msg_timestamp"])
+    op.execute(f"INSERT INTO {table_name} TABLE {table_name}_backup")
+    op.drop_table(f"{table_name}_backup")
+
+
+def downgrade():
+    _to_regular_table("users_messages", "user_id", "users")
+    _to_regular_table("packages_messages", "package_id", "packages")
@@ -0,0 +1,34 @@
+"""Add a table to find the timestamp of a message from its id
+
+Revision ID: 7a3c91e0d4b2
+Revises: 00a637ab08a5
+Create Date: 2026-10-18 23:05:17.418263
+
+Stop the consumer while upgrading: the messages that are added after the table is filled
+and before the consumer is upgraded would not be found by Message.from_msg_id().
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7a3c91e0d4b2"
+down_revision = "00a637ab08a5"
+
+
+def upgrade():
+    op.create_table(
+        "message_ids",
+        sa.Column("msg_id", sa.Unicode(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("msg_id"),
+    )
+    op.execute(
+        "INSERT INTO message_ids (msg_id, timestamp) "
+        "SELECT msg_id, min(timestamp) FROM messages WHERE msg_id IS NOT NULL GROUP BY msg_id"
+    )
+
+
+def downgrade():
+    op.drop_table("message_ids")
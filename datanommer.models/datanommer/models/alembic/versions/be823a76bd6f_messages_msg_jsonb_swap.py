@@ -0,0 +1,44 @@
+"""Convert messages.msg to JSONB
+
+Revision ID: be823a76bd6f
+Revises: fdfbee46d76f
+Create Date: 2026-10-18 10:48:03.311942
+
+Run tools/backfill-msg-jsonb.py before this revision, otherwise the remaining rows will
+be converted here, in a single transaction.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "be823a76bd6f"
+down_revision = "fdfbee46d76f"
+
+
+def upgrade():
+    op.execute(
+        "UPDATE messages SET msg_jsonb = datanommer_msg_to_jsonb(msg) WHERE msg_jsonb IS NULL"
+    )
+    op.execute("DROP TRIGGER messages_sync_msg_jsonb ON messages")
+    op.execute("DROP FUNCTION datanommer_sync_msg_jsonb()")
+    op.execute("DROP FUNCTION datanommer_msg_to_jsonb(text)")
+    op.drop_column("messages", "msg")
+    op.alter_column("messages", "msg_jsonb", new_column_name="msg", nullable=False)
+    op.create_index(
+        "ix_messages_msg",
+        "messages",
+        ["msg"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"msg": "jsonb_path_ops"},
+    )
+
+
+def downgrade():
+    op.drop_index("ix_messages_msg", table_name="messages", postgresql_using="gin")
+    op.add_column("messages", sa.Column("msg_text", sa.UnicodeText(), nullable=True))
+    op.execute("UPDATE messages SET msg_text = msg::text")
+    op.drop_column("messages", "msg")
+    op.alter_column("messages", "msg_text", new_column_name="msg", nullable=False)
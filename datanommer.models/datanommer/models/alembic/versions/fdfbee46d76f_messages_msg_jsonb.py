@@ -0,0 +1,57 @@
+"""Add a JSONB copy of messages.msg
+
+Revision ID: fdfbee46d76f
+Revises: 429e6f2cba6f
+Create Date: 2026-10-18 10:12:41.572203
+
+This is the first step of the conversion of messages.msg to JSONB. New and updated rows
+are copied to the new column by a trigger, the existing rows must be copied with
+tools/backfill-msg-jsonb.py before upgrading to the next revision.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "fdfbee46d76f"
+down_revision = "429e6f2cba6f"
+
+
+def upgrade():
+    op.add_column("messages", sa.Column("msg_jsonb", postgresql.JSONB(), nullable=True))
+    # JSONB does not support the NULL character, strip it like we did when migrating to
+    # TimescaleDB. If the text still isn't valid JSON, store it as a JSON string.
+    op.execute(
+        """
+        CREATE FUNCTION datanommer_msg_to_jsonb(msg text) RETURNS jsonb AS $$
+        BEGIN
+            RETURN replace(msg, '\\u0000', '')::jsonb;
+        EXCEPTION WHEN invalid_text_representation THEN
+            RETURN to_jsonb(msg);
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE
+        """
+    )
+    op.execute(
+        """
+        CREATE FUNCTION datanommer_sync_msg_jsonb() RETURNS trigger AS $$
+        BEGIN
+            NEW.msg_jsonb := datanommer_msg_to_jsonb(NEW.msg);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        "CREATE TRIGGER messages_sync_msg_jsonb BEFORE INSERT OR UPDATE OF msg ON messages "
+        "FOR EACH ROW EXECUTE FUNCTION datanommer_sync_msg_jsonb()"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER messages_sync_msg_jsonb ON messages")
+    op.execute("DROP FUNCTION datanommer_sync_msg_jsonb()")
+    op.execute("DROP FUNCTION datanommer_msg_to_jsonb(text)")
+    op.drop_column("messages", "msg_jsonb")
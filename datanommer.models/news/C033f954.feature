@@ -0,0 +1,2 @@
+Add the ``estimate`` and ``none`` counting modes to ``Message.grep()``, to avoid
+counting all the matching messages
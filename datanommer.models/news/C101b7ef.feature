@@ -0,0 +1,3 @@
+Add optional default and maximum time windows to the message queries, set with
+the ``default_window`` and ``max_window`` arguments of ``init()``. Pass
+``report_clamped=True`` to the queries to know if the time range was limited
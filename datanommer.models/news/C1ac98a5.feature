@@ -0,0 +1,2 @@
+Add a ``messages_hourly`` continuous aggregate of the hourly message counts per
+topic, category and agent
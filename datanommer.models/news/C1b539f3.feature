@@ -0,0 +1,2 @@
+Detect duplicate messages with ``ON CONFLICT DO NOTHING`` instead of a query per
+message
@@ -0,0 +1,2 @@
+Add ``Message.stream()`` and ``Message.stream_query()`` to go through many
+messages in constant memory, and ``Message.count_query()`` to count them
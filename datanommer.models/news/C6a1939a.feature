@@ -0,0 +1,2 @@
+Cache the user and package ids in bounded LRU caches, with a configurable size and
+time to live, which can be pre-loaded on startup
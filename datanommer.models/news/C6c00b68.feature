@@ -0,0 +1,2 @@
+Add an optional result cache to ``Message.grep()``, enabled with the
+``grep_cache`` argument of ``init()``
@@ -0,0 +1,2 @@
+Add a ``load_related`` argument to ``Message.grep()`` to load the users and
+packages of all the messages in two queries
@@ -0,0 +1 @@
+Create the missing users and packages of a message in a single statement
@@ -0,0 +1,2 @@
+Add ``Message.bulk_create()`` and ``add_many()`` to store many messages in a few
+statements. A batch is stored or rejected as a whole
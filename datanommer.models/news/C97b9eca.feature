@@ -0,0 +1,2 @@
+Filter the messages on users and packages with a single subquery on the
+association tables
@@ -0,0 +1 @@
+Add a ``columns`` argument to ``Message.grep()`` to only load some columns
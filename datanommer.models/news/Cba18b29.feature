@@ -0,0 +1,3 @@
+Pass the lists of filter values as array parameters, so that the queries are
+compiled once whatever the number of values. A single value is compared with a
+plain equality, to use the composite indexes
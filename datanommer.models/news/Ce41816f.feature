@@ -0,0 +1,2 @@
+Add ``Message.grep_cursor()`` to go through the pages of results with a cursor
+instead of a page number
@@ -16,11 +16,13 @@
 import datetime
 import json
 import logging
+import math
+from contextlib import contextmanager
 
 import pytest
 from bodhi.messages.schemas.update import UpdateCommentV1
 from fedora_messaging import message as fedora_message
-from sqlalchemy import create_engine, func, select
+from sqlalchemy import create_engine, event, func, inspect, select, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql.selectable import Select
 
@@ -62,6 +64,21 @@ def generate_bodhi_update_complete_message(text="testing testing"):
     return msg
 
 
+@contextmanager
+def executed_statements():
+    statements = []
+    engine = dm.session.get_bind()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 @pytest.fixture
 def add_200_messages(datanommer_models):
     for x in range(0, 200):
@@ -119,6 +136,89 @@ def test_from_msg_id(datanommer_models):
     assert dbmsg.msg_id == "ACUSTOMMESSAGEID"
 
 
+def test_from_msg_id_unknown(datanommer_models):
+    dm.add(generate_message())
+    assert dm.Message.from_msg_id("unknown") is None
+
+
+def test_from_msg_id_uses_timestamp(datanommer_models):
+    example_message = generate_message()
+    dm.add(example_message)
+    timestamp = dm.session.scalar(
+        select(dm.message_ids_table.c.timestamp).where(
+            dm.message_ids_table.c.msg_id == example_message.id
+        )
+    )
+    assert timestamp == dm.session.scalar(select(dm.Message.timestamp))
+
+    with executed_statements() as statements:
+        dbmsg = dm.Message.from_msg_id(example_message.id)
+    assert dbmsg.msg_id == example_message.id
+    assert len(statements) == 1
+    assert "message_ids" in statements[0]
+    assert "messages.timestamp) IN" in statements[0]
+
+
+def test_from_msg_id_time_hint(datanommer_models):
+    example_message = generate_message()
+    dm.add(example_message)
+    timestamp = dm.session.scalar(select(dm.Message.timestamp))
+
+    with executed_statements() as statements:
+        dbmsg = dm.Message.from_msg_id(example_message.id, time_hint=timestamp)
+    assert dbmsg.msg_id == example_message.id
+    assert len(statements) == 1
+    assert "message_ids" not in statements[0]
+
+    # A wrong hint falls back to the lookup table
+    with executed_statements() as statements:
+        dbmsg = dm.Message.from_msg_id(
+            example_message.id, time_hint=timestamp - datetime.timedelta(days=10)
+        )
+    assert dbmsg.msg_id == example_message.id
+    assert len(statements) == 2
+
+
+def test_from_msg_ids(add_200_messages):
+    messages = dm.Message.from_msg_ids(["12", "unknown", "3", "150"])
+    assert [message.msg_id for message in messages] == ["12", "3", "150"]
+    assert dm.Message.from_msg_ids([]) == []
+
+
+def test_messages_hourly(datanommer_models):
+    for minute, topic in ((0, "a.b.one"), (30, "a.b.one"), (90, "a.b.two"), (95, "a.c.one")):
+        example_message = generate_message(topic=f"org.fedoraproject.prod.{topic}")
+        sent_at = datetime.datetime(2021, 7, 27, 4) + datetime.timedelta(minutes=minute)
+        example_message._properties.headers["sent-at"] = sent_at.isoformat()
+        dm.add(example_message)
+
+    hourly = dm.messages_hourly
+    rows = dm.session.execute(
+        select(hourly.c.hour, hourly.c.topic, hourly.c.messages).order_by(
+            hourly.c.hour, hourly.c.topic
+        )
+    ).all()
+    assert [tuple(row) for row in rows] == [
+        (datetime.datetime(2021, 7, 27, 4), "org.fedoraproject.prod.a.b.one", 2),
+        (datetime.datetime(2021, 7, 27, 5), "org.fedoraproject.prod.a.b.two", 1),
+        (datetime.datetime(2021, 7, 27, 5), "org.fedoraproject.prod.a.c.one", 1),
+    ]
+
+
+def test_add_nul_character(datanommer_models):
+    example_message = generate_message(
+        topic="org.fedoraproject.prod.test\x00",
+        body={"text": "a\x00b", "list": ["\x00", 1], "key\x00": None},
+    )
+    example_message._properties.headers["usernames"] = ["user\x00"]
+    dm.add(example_message)
+
+    dbmsg = dm.session.scalar(select(dm.Message))
+    assert dbmsg.topic == "org.fedoraproject.prod.test"
+    assert dbmsg.msg == {"text": "ab", "list": ["", 1], "key": None}
+    assert dbmsg.headers["usernames"] == ["user"]
+
+
 def test_add_missing_msg_id(datanommer_models, caplog):
     caplog.set_level(logging.INFO)
     example_message = generate_message()
@@ -191,6 +291,72 @@ def test_add_and_check_for_others(datanommer_models):
     assert dm.session.scalar(select(func.count(dm.Package.id))) == 2
 
 
+def test_add_many(datanommer_models):
+    messages = []
+    for x in range(0, 3):
+        example_message = generate_message()
+        example_message.id = f"{x}"
+        messages.append(example_message)
+    # Duplicates and invalid messages don't prevent the others from being stored
+    messages.append(messages[0])
+    invalid_message = generate_message()
+    invalid_message._properties.headers["sent-at"] = "2021-07-27T04:22:42JUNK"
+    messages.append(invalid_message)
+    messages.append(generate_bodhi_update_complete_message())
+
+    dm.add_many(messages)
+
+    assert dm.session.scalar(select(func.count(dm.Message.id))) == 4
+    assert dm.session.scalar(select(func.count(dm.User.id))) == 2
+
+
+def test_bulk_create(datanommer_models, caplog):
+    timestamp = datetime.datetime(2021, 7, 27, 4, 22, 42, tzinfo=datetime.timezone.utc)
+
+    def _values(msg_id, timestamp=timestamp, users=None, packages=None):
+        return dict(
+            i=0,
+            msg_id=msg_id,
+            topic="org.fedoraproject.prod.bodhi.update.comment",
+            timestamp=timestamp,
+            msg={"encouragement": "You're doing great!"},
+            headers=None,
+            agent_name=None,
+            users=users or [],
+            packages=packages or [],
+        )
+
+    messages = [
+        _values("msg-1", users=["dummy-1", "dummy-2"], packages=["pkg", "pkg"]),
+        _values("msg-2", users=["dummy-2"]),
+        # Exact duplicate
+        _values("msg-1", users=["dummy-1", "dummy-2"], packages=["pkg", "pkg"]),
+        # Same msg_id but another timestamp
+        _values("msg-2", timestamp + datetime.timedelta(days=1), users=["dummy-3"]),
+        _values(None),
+    ]
+    assert dm.Message.bulk_create(messages) == 4
+    # Already in the database
+    assert dm.Message.bulk_create(messages[:1]) == 0
+    assert dm.Message.bulk_create([]) == 0
+    assert "Skipping message from org.fedoraproject.prod.bodhi.update.comment" in caplog.text
+
+    assert dm.session.scalar(select(func.count(dm.Message.id))) == 4
+    assert dm.session.scalar(select(func.count(dm.User.id))) == 3
+    assert dm.session.scalar(select(func.count(dm.Package.id))) == 1
+
+    msg_1 = dm.Message.from_msg_id("msg-1")
+    assert msg_1.category == "bodhi"
+    assert msg_1.source_name == "datanommer"
+    assert msg_1.source_version == dm.__version__
+    assert msg_1.as_dict()["users"] == ["dummy-1", "dummy-2"]
+    assert msg_1.as_dict()["packages"] == ["pkg"]
+    msgs_2 = dm.session.scalars(
+        select(dm.Message).where(dm.Message.msg_id == "msg-2").order_by(dm.Message.timestamp)
+    ).all()
+    assert [msg.as_dict()["users"] for msg in msgs_2] == [["dummy-2"], ["dummy-3"]]
+
+
 def test_add_nothing(datanommer_models):
     assert dm.session.scalar(select(func.count(dm.Message.id))) == 0
 
@@ -208,6 +374,23 @@ def test_categories(datanommer_models):
     assert obj.category == "bodhi"
 
 
+def test_category_on_topic_change():
+    msg = dm.Message(topic="org.fedoraproject.prod.bodhi.update.comment")
+    assert msg.category == "bodhi"
+    msg.topic = "too.short"
+    assert msg.category == "Unclassified"
+
+
+def test_insert_list(datanommer_models):
+    dm.add(generate_message())
+    dbmsg = dm.session.scalar(select(dm.Message))
+    dbmsg._insert_list(dm.User, dm.users_assoc_table, ["dummy-1", "dummy-2", "dummy-1"])
+    dbmsg._insert_list(dm.Package, dm.packages_assoc_table, [])
+    dm.session.refresh(dbmsg)
+    assert sorted(u.name for u in dbmsg.users) == ["dummy-1", "dummy-2"]
+    assert dbmsg.packages == []
+
+
 def test_categories_with_umb(datanommer_models):
     dm.add(generate_message(topic="/topic/VirtualTopic.eng.brew.task.closed"))
     dm.session.flush()
@@ -319,6 +502,66 @@ def test_grep_start_end(datanommer_models):
     assert messages[0].msg == bodhi_example_message.body
 
 
+def test_clamp_time_window(mocker):
+    day = datetime.timedelta(days=1)
+    start, end = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 10)
+    assert dm.Message.clamp_time_window(None, None) == (None, None, False)
+    assert dm.Message.clamp_time_window(start, end) == (start, end, False)
+
+    mocker.patch.object(dm.Message, "max_window", 2 * day)
+    assert dm.Message.clamp_time_window(start, end) == (end - 2 * day, end, True)
+    assert dm.Message.clamp_time_window(end - day, end) == (end - day, end, False)
+    new_start, new_end, clamped = dm.Message.clamp_time_window(None, None)
+    assert new_end - new_start == 2 * day
+    assert clamped
+
+    mocker.patch.object(dm.Message, "default_window", day)
+    new_start, new_end, clamped = dm.Message.clamp_time_window(None, None)
+    assert new_end - new_start == day
+    assert clamped
+    # The default window can't be larger than the maximum window
+    mocker.patch.object(dm.Message, "default_window", 3 * day)
+    new_start, new_end, clamped = dm.Message.clamp_time_window(None, None)
+    assert new_end - new_start == 2 * day
+
+
+def test_grep_time_window_limits(datanommer_models, mocker, caplog):
+    old_message = generate_message()
+    old_message._headers["sent-at"] = "2020-01-01T12:00:00+00:00"
+    dm.add(old_message)
+    dm.add(generate_message())
+    assert dm.Message.grep()[0] == 2
+
+    mocker.patch.object(dm.Message, "default_window", datetime.timedelta(days=1))
+    mocker.patch.object(dm.Message, "max_window", datetime.timedelta(days=30))
+    caplog.set_level(logging.INFO)
+    assert dm.Message.grep()[0] == 1
+    assert "The time range of the query was limited to" in caplog.text
+    window = {"start": datetime.datetime(2020, 1, 1), "end": datetime.datetime(2020, 1, 2)}
+    assert dm.Message.grep(**window)[0] == 1
+    window = {"start": datetime.datetime(2019, 1, 1), "end": datetime.datetime(2021, 1, 1)}
+    assert dm.Message.grep(**window)[0] == 0
+
+
+def test_grep_report_clamped(datanommer_models, mocker):
+    dm.add(generate_message())
+    window = {"start": datetime.datetime(2020, 1, 1), "end": datetime.datetime(2020, 1, 2)}
+    assert len(dm.Message.grep()) == 3
+    assert dm.Message.grep(report_clamped=True)[3] is False
+    assert dm.Message.grep_cursor(report_clamped=True)[2] is False
+    assert dm.Message.make_query(report_clamped=True)[1] is False
+
+    mocker.patch.object(dm.Message, "default_window", datetime.timedelta(days=1))
+    mocker.patch.object(dm.Message, "max_window", datetime.timedelta(days=30))
+    total, pages, messages, clamped = dm.Message.grep(report_clamped=True)
+    assert (total, clamped) == (1, True)
+    assert dm.Message.grep(report_clamped=True, defer=True)[3] is True
+    assert dm.Message.grep(report_clamped=True, **window)[3] is False
+    messages, next_cursor, clamped = dm.Message.grep_cursor(report_clamped=True)
+    assert (len(messages), clamped) == (1, True)
+    assert len(dm.Message.grep_cursor()) == 2
+
+
 def test_grep_msg_id(datanommer_models):
     example_message = generate_message()
     dm.add(example_message)
@@ -430,6 +673,76 @@ def test_grep_not_users(datanommer_models):
     assert messages[0].msg == example_message.body
 
 
+def test_grep_users_time_range(datanommer_models):
+    bodhi_example_message = generate_bodhi_update_complete_message()
+    bodhi_example_message._headers["sent-at"] = "2024-01-01T12:00:00+00:00"
+    dm.add(bodhi_example_message)
+    dm.session.flush()
+
+    def grep_users(start, end, **kwargs):
+        return dm.Message.grep(
+            start=datetime.datetime(*start), end=datetime.datetime(*end), **kwargs
+        )[0]
+
+    assert grep_users((2024, 1, 1), (2024, 1, 2), users=["dudemcpants"]) == 1
+    assert grep_users((2024, 1, 2), (2024, 1, 3), users=["dudemcpants"]) == 0
+    assert grep_users((2024, 1, 1), (2024, 1, 2), not_users=["dudemcpants"]) == 0
+    assert grep_users((2024, 1, 1), (2024, 1, 2), not_users=["ralph"]) == 1
+
+
+def test_grep_users_not_cached(datanommer_models):
+    bodhi_example_message = generate_bodhi_update_complete_message()
+    dm.add(bodhi_example_message)
+    dm.session.flush()
+    dm.User.clear_cache()
+
+    # Unknown names match no message
+    total, pages, messages = dm.Message.grep(users=["dudemcpants", "nobody"])
+    assert total == 1
+    assert dm.User.get_ids(["dudemcpants", "nobody"]) == {
+        "dudemcpants": dm.User.get_ids(["dudemcpants"])["dudemcpants"]
+    }
+    assert "dudemcpants" in dm.User._cache
+    assert dm.Message.grep(users=["nobody"])[0] == 0
+    assert dm.Message.grep(not_users=["nobody"])[0] == 1
+
+
+def test_grep_users_single_subquery(datanommer_models):
+    query = dm.Message.make_query(users=[f"user{index}" for index in range(50)])
+    sql = str(query.compile())
+    assert sql.count("FROM users_messages") == 1
+    assert "users.name" not in sql
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected",
+    [
+        ({"topics": ["a"]}, "messages.topic = %(topic_1)s"),
+        ({"topics": ["a", "b"]}, "messages.topic = ANY (%(param_1)s::TEXT[])"),
+        ({"categories": ["a"]}, "messages.category = %(category_1)s"),
+        ({"not_categories": ["a"]}, "messages.category != %(category_1)s"),
+        ({"not_categories": ["a", "b"]}, "NOT (messages.category = ANY (%(param_1)s::TEXT[]))"),
+        ({"agents": ["a"]}, "messages.agent_name = %(agent_name_1)s"),
+        ({"not_agents": ["a", "b"]}, "NOT (messages.agent_name = ANY (%(param_1)s::TEXT[]))"),
+    ],
+)
+def test_grep_single_value_equality(datanommer_models, kwargs, expected):
+    query = dm.Message.make_query(**kwargs)
+    assert expected in str(query.compile(dialect=dm.session.get_bind().dialect))
+
+
+def test_grep_time_range_on_associations(datanommer_models):
+    query = dm.Message.make_query(
+        start=datetime.datetime(2024, 1, 1),
+        end=datetime.datetime(2024, 1, 2),
+        users=["dudemcpants"],
+        not_packages=["kernel"],
+    )
+    sql = str(query.compile())
+    assert "users_messages.msg_timestamp BETWEEN" in sql
+    assert "packages_messages.msg_timestamp BETWEEN" in sql
+
+
 def test_grep_packages(datanommer_models):
     example_message = generate_message()
     dm.add(example_message)
@@ -477,6 +790,81 @@ def test_grep_contains(datanommer_models):
     assert r[0].msg == example_message.body
 
 
+def test_grep_body_contains(datanommer_models):
+    example_message = generate_message()
+    dm.add(example_message)
+    bodhi_example_message = generate_bodhi_update_complete_message()
+    dm.add(bodhi_example_message)
+    dm.session.flush()
+
+    t, p, r = dm.Message.grep(body_contains=[{"comment": {"user": {"name": "dudemcpants"}}}])
+    assert t == 1
+    assert r[0].msg == bodhi_example_message.body
+
+    t, p, r = dm.Message.grep(
+        body_contains=[{"comment": {"karma": 1}}, {"encouragement": "You're doing great!"}]
+    )
+    assert t == 1
+    assert r[0].msg == example_message.body
+
+
+def test_grep_body_paths(datanommer_models):
+    example_message = generate_message()
+    dm.add(example_message)
+    bodhi_example_message = generate_bodhi_update_complete_message()
+    dm.add(bodhi_example_message)
+    dm.session.flush()
+
+    t, p, r = dm.Message.grep(body_paths=["$.comment ? (@.karma < 0)"])
+    assert t == 1
+    assert r[0].msg == bodhi_example_message.body
+
+    t, p, r = dm.Message.grep(body_paths=["$.comment ? (@.karma > 0)"])
+    assert t == 0
+
+    t, p, r = dm.Message.grep(body_paths=["$.encouragement", "$.comment.update.builds[1]"])
+    assert t == 2
+
+
+def test_grep_columns(datanommer_models, add_200_messages):
+    total, pages, messages = dm.Message.grep(columns=["topic", "msg_id"])
+    assert total == 200
+    assert len(messages) == 100
+    unloaded = inspect(messages[0]).unloaded
+    assert "msg" in unloaded
+    assert "headers" in unloaded
+    assert "topic" not in unloaded
+    assert "timestamp" not in unloaded
+    # The deferred columns are loaded on access
+    assert messages[0].msg == {"encouragement": "You're doing great!"}
+    # The other count modes work too
+    assert dm.Message.grep(columns=["topic"], count="estimate")[0] > 0
+    assert dm.Message.grep(columns=["topic"], count="none")[1] == 2
+
+
+def test_grep_columns_unknown(datanommer_models):
+    with pytest.raises(ValueError, match="Unknown columns: foo, users"):
+        dm.Message.grep(columns=["topic", "users", "foo"])
+
+
+@pytest.mark.parametrize("count", [5, 20])
+def test_grep_load_related(datanommer_models, count):
+    for _ in range(count):
+        dm.add(generate_bodhi_update_complete_message())
+    dm.session.flush()
+    dm.session.expunge_all()
+
+    with executed_statements() as statements:
+        total, pages, messages = dm.Message.grep(load_related=True)
+        dicts = [message.as_dict() for message in messages]
+
+    assert len(dicts) == count
+    assert dicts[0]["users"] == ["dudemcpants", "ryanlerch"]
+    assert dicts[0]["packages"] == ["abrt-addon-python3", "kernel"]
+    # The count, the messages, the users and the packages, whatever the number of messages
+    assert len(statements) == 4
+
+
 def test_grep_rows_per_page(datanommer_models, add_200_messages):
     total, pages, messages = dm.Message.grep()
     assert total == 200
@@ -519,6 +907,238 @@ def test_grep_no_total_if_single_page(datanommer_models, add_200_messages, mocke
     scalar_spy.assert_not_called()
 
 
+def test_grep_count_estimate(datanommer_models, add_200_messages):
+    dm.session.execute(text("ANALYZE messages"))
+    total, pages, messages = dm.Message.grep(count="estimate")
+    # The planner's estimate is not exact
+    assert 100 < total < 400
+    assert pages == math.ceil(total / 100)
+    assert len(messages) == 100
+    total, pages, query = dm.Message.grep(count="estimate", rows_per_page=0, defer=True)
+    assert 100 < total < 400
+
+
+def test_grep_count_none(datanommer_models, add_200_messages, mocker):
+    scalar_spy = mocker.spy(dm.session, "scalar")
+    total, pages, messages = dm.Message.grep(count="none")
+    assert total is None
+    assert pages == 2
+    assert len(messages) == 100
+    total, pages, messages = dm.Message.grep(count="none", page=2)
+    assert total is None
+    assert pages == 2
+    assert len(messages) == 100
+    scalar_spy.assert_not_called()
+
+
+def test_grep_count_none_defer(datanommer_models, add_200_messages):
+    total, pages, query = dm.Message.grep(count="none", defer=True)
+    assert total is None
+    assert pages is None
+    assert len(dm.session.scalars(query).all()) == 100
+    total, pages, query = dm.Message.grep(count="none", rows_per_page=0, defer=True)
+    assert total is None
+    assert pages == 1
+
+
+def test_grep_count_invalid(datanommer_models):
+    with pytest.raises(ValueError, match="The count must be one of exact, estimate or none"):
+        dm.Message.grep(count="maybe")
+
+
+@pytest.fixture
+def grep_cache(mocker):
+    cache = dm.GrepCache()
+    mocker.patch.object(dm.Message, "grep_cache", cache)
+    return cache
+
+
+def test_grep_cache(datanommer_models, grep_cache):
+    dm.add(generate_message(topic="org.fedoraproject.test.a"))
+    dm.add(generate_message(topic="org.fedoraproject.test.b"))
+    total, pages, messages = dm.Message.grep(topics=["org.fedoraproject.test.a"])
+    assert total == 1
+
+    with executed_statements() as statements:
+        cached = dm.Message.grep(topics=["org.fedoraproject.test.a"])
+    assert statements == []
+    assert cached[:2] == (total, pages)
+    assert [message.msg_id for message in cached[2]] == [messages[0].msg_id]
+    assert cached[2][0] in dm.session
+    # Changing the returned messages does not change the cache
+    dm.session.expunge_all()
+    cached[2][0].msg["encouragement"] = "changed"
+    message = dm.Message.grep(topics=["org.fedoraproject.test.a"])[2][0]
+    assert message.msg == {"encouragement": "You're doing great!"}
+
+
+def test_grep_cache_report_clamped(datanommer_models, grep_cache, mocker):
+    dm.add(generate_message())
+    mocker.patch.object(dm.Message, "max_window", datetime.timedelta(days=30))
+    assert len(dm.Message.grep()) == 3
+    with executed_statements() as statements:
+        total, pages, messages, clamped = dm.Message.grep(report_clamped=True)
+    assert statements != []
+    with executed_statements() as statements:
+        assert dm.Message.grep(report_clamped=True)[::3] == (total, clamped)
+    assert statements == []
+    assert clamped is True
+
+
+def test_grep_cache_key(datanommer_models, grep_cache):
+    dm.Message.grep(topics=["a", "b"], body_contains=[{"a": 1}], start=None, end=None)
+    with executed_statements() as statements:
+        dm.Message.grep(topics=["b", "a", "a"], body_contains=[{"a": 1}])
+    assert statements == []
+    with executed_statements() as statements:
+        dm.Message.grep(topics=["a", "b"], body_contains=[{"a": 1}], page=2)
+    assert statements != []
+
+
+def test_grep_cache_invalidation(datanommer_models, grep_cache):
+    old_message = generate_message()
+    old_message._headers["sent-at"] = "2020-01-01T12:00:00+00:00"
+    dm.add(old_message)
+    dm.add(generate_message())
+    window = {"start": datetime.datetime(2020, 1, 1), "end": datetime.datetime(2020, 1, 2)}
+    assert dm.Message.grep()[0] == 2
+    assert dm.Message.grep(**window)[0] == 1
+
+    # A new message invalidates the results of the recent windows only
+    dm.add(generate_message())
+    with executed_statements() as statements:
+        assert dm.Message.grep(**window)[0] == 1
+    assert statements == []
+    assert dm.Message.grep()[0] == 3
+
+    # An old message invalidates everything
+    old_message = generate_message()
+    old_message._headers["sent-at"] = "2020-01-01T13:00:00+00:00"
+    dm.add_many([old_message])
+    assert dm.Message.grep(**window)[0] == 2
+    assert dm.Message.grep()[0] == 4
+
+
+def test_grep_cache_copies_messages(datanommer_models, grep_cache):
+    dm.add(generate_message())
+    messages = dm.Message.grep()[2]
+    # Changing the messages of the first query does not change the cache
+    messages[0].msg["encouragement"] = "changed"
+    messages[0].headers["priority"] = 10
+    dm.session.expunge_all()
+    with executed_statements() as statements:
+        message = dm.Message.grep()[2][0]
+    assert statements == []
+    assert message.msg == {"encouragement": "You're doing great!"}
+    assert message.headers["priority"] == 0
+
+
+def test_grep_cache_load_related(datanommer_models, grep_cache):
+    dm.add(generate_bodhi_update_complete_message())
+    dm.add(generate_message())
+    expected = [message.as_dict() for message in dm.Message.grep(load_related=True)[2]]
+    dm.session.expunge_all()
+    with executed_statements() as statements:
+        messages = dm.Message.grep(load_related=True)[2]
+        assert [message.as_dict() for message in messages] == expected
+    assert statements == []
+    assert expected[0]["users"] == ["dudemcpants", "ryanlerch"]
+
+
+def test_grep_cache_columns(datanommer_models, grep_cache):
+    dm.add(generate_message())
+    dm.Message.grep(columns=["topic"])
+    dm.session.expunge_all()
+    message = dm.Message.grep(columns=["topic"])[2][0]
+    assert "msg" in inspect(message).unloaded
+    assert message.msg == {"encouragement": "You're doing great!"}
+
+
+def test_grep_cache_defer(datanommer_models, grep_cache):
+    dm.add(generate_message())
+    total, pages, query = dm.Message.grep(defer=True)
+    assert isinstance(query, Select)
+    assert not any(key.startswith("datanommer:grep:") for key in grep_cache.backend._data)
+
+
+def test_grep_cursor(datanommer_models, add_200_messages):
+    # Many messages have the same timestamp, they are sorted by id
+    expected = dm.session.scalars(
+        select(dm.Message).order_by(dm.Message.timestamp, dm.Message.id)
+    ).all()
+    messages, cursor = dm.Message.grep_cursor(rows_per_page=70)
+    assert messages == expected[:70]
+    messages, cursor = dm.Message.grep_cursor(cursor=cursor, rows_per_page=70)
+    assert messages == expected[70:140]
+    messages, cursor = dm.Message.grep_cursor(cursor=cursor, rows_per_page=70)
+    assert messages == expected[140:]
+    assert cursor is None
+
+
+def test_grep_cursor_desc(datanommer_models):
+    # Messages with the same timestamp are sorted by id
+    timestamp = datetime.datetime(2024, 1, 1)
+    for index in range(5):
+        example_message = generate_message(topic=f"org.fedoraproject.test.{index}")
+        example_message._headers["sent-at"] = timestamp.isoformat()
+        dm.add(example_message)
+    topics = []
+    cursor = None
+    while True:
+        messages, cursor = dm.Message.grep_cursor(cursor=cursor, rows_per_page=2, order="desc")
+        topics.extend(message.topic for message in messages)
+        if cursor is None:
+            break
+    assert topics == [f"org.fedoraproject.test.{index}" for index in reversed(range(5))]
+
+
+def test_grep_cursor_filters(datanommer_models, add_200_messages):
+    messages, cursor = dm.Message.grep_cursor(topics=["org.fedoraproject.test.other"])
+    assert messages == []
+    assert cursor is None
+
+
+@pytest.mark.parametrize("cursor", ["invalid", "WzFd", "WyJub3QgYSBkYXRlIiwgMV0="])
+def test_grep_cursor_invalid(datanommer_models, cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        dm.Message.grep_cursor(cursor=cursor)
+
+
+def test_grep_cursor_invalid_order(datanommer_models):
+    with pytest.raises(ValueError, match="The order must be either asc or desc"):
+        dm.Message.grep_cursor(order="sideways")
+
+
+def test_stream(datanommer_models, add_200_messages):
+    dm.session.expunge_all()
+    positions = []
+    for message in dm.Message.stream(batch_size=30, order="desc"):
+        positions.append((message.timestamp, message.id))
+        # Only the current batch is kept in the session
+        assert len(dm.session.identity_map) <= 30
+    assert len(positions) == 200
+    assert positions == sorted(positions, reverse=True)
+
+
+def test_stream_filters(datanommer_models):
+    dm.add(generate_message())
+    bodhi_example_message = generate_bodhi_update_complete_message()
+    dm.add(bodhi_example_message)
+    dm.session.flush()
+    messages = list(dm.Message.stream(users=["dudemcpants"], load_related=True))
+    assert [message.msg_id for message in messages] == [bodhi_example_message.id]
+
+
+def test_stream_query(datanommer_models, add_200_messages):
+    query = select(dm.Message).where(dm.Message.msg_id < "5").order_by(dm.Message.msg_id)
+    messages = list(dm.Message.stream_query(query, batch_size=2))
+    assert [message.msg_id for message in messages] == sorted(
+        str(index) for index in range(200) if str(index) < "5"
+    )
+    assert dm.Message.count_query(query) == len(messages)
+    assert dm.Message.count_query(query, "estimate") > 0
+
+
 def test_get_first(datanommer_models):
     messages = []
     for x in range(0, 200):
@@ -535,6 +1155,7 @@ def test_get_first(datanommer_models):
 def test_add_duplicate(datanommer_models, caplog):
     example_message = generate_message()
     dm.add(example_message)
+    skipped_duplicates = dm.Message.skipped_duplicates
     dm.add(example_message)
     # if no exception was thrown, then we successfully ignored the
     # duplicate message
@@ -542,11 +1163,29 @@ def test_add_duplicate(datanommer_models, caplog):
     assert (
         "Skipping message from org.fedoraproject.test.a.nice.message" in caplog.records[0].message
     )
+    assert dm.Message.skipped_duplicates == skipped_duplicates + 1
+
+
+def test_create_duplicate(datanommer_models):
+    values = dict(
+        i=0,
+        msg_id="ACUSTOMMESSAGEID",
+        topic="org.fedoraproject.test.a.nice.message",
+        timestamp=datetime.datetime.now(),
+        msg={"encouragement": "You're doing great!"},
+        users=["dummy"],
+        packages=[],
+    )
+    assert dm.Message.create(**values) is True
+    assert dm.Message.create(**values) is False
+    # The transaction has not been aborted by the duplicate
+    dm.session.commit()
+    assert dm.session.scalar(select(func.count(dm.Message.id))) == 1
 
 
 def test_add_integrity_error(datanommer_models, mocker, caplog):
-    mock_session_add = mocker.patch("datanommer.models.session.add")
-    mock_session_add.side_effect = IntegrityError("asdf", "asd", "asdas")
+    mock_session_execute = mocker.patch("datanommer.models.session.execute")
+    mock_session_execute.side_effect = IntegrityError("asdf", "asd", "asdas")
     example_message = generate_message()
     dm.add(example_message)
     assert "Unknown Integrity Error: message" in caplog.records[0].message
@@ -712,3 +1351,116 @@ def test_singleton_get_existing(datanommer_models):
     dm.Package._cache.clear()
     p2 = dm.Package.get_or_create("foobar")
     assert p1.id == p2.id
+
+
+def test_singleton_ensure_many(datanommer_models, mocker):
+    existing = dm.Package.get_or_create("pkg-1")
+    dm.Package.clear_cache()
+    execute = mocker.spy(dm.session, "execute")
+    ids = dm.Package.ensure_many(["pkg-1", "pkg-2", "pkg-3", "pkg-2"])
+    # A single query for all the names
+    execute.assert_called_once()
+    assert ids["pkg-1"] == existing.id
+    assert sorted(ids) == ["pkg-1", "pkg-2", "pkg-3"]
+    assert {p.name: p.id for p in dm.session.scalars(select(dm.Package))} == ids
+    assert dm.Package.ensure_many([]) == {}
+
+
+def test_singleton_get_cached(datanommer_models, mocker):
+    p1 = dm.Package.get_or_create("foobar")
+    execute = mocker.spy(dm.session, "execute")
+    assert dm.Package.ensure_many(["foobar"]) == {"foobar": p1.id}
+    execute.assert_not_called()
+
+
+def test_singleton_cache_cleared_on_rollback(datanommer_models):
+    dm.Package.get_or_create("foobar")
+    assert "foobar" in dm.Package._cache
+    dm.session.rollback()
+    assert "foobar" not in dm.Package._cache
+    assert dm.session.scalar(select(func.count(dm.Package.id))) == 0
+
+
+def test_singleton_warm_cache(datanommer_models):
+    ids = dm.Package.ensure_many(["pkg-1", "pkg-2", "pkg-3"])
+    dm.session.commit()
+    dm.Package.clear_cache()
+    dm.Package._cache.configure(max_size=2)
+    try:
+        dm.Package.warm_cache()
+        # Only the most recent ones are loaded
+        assert "pkg-1" not in dm.Package._cache
+        assert dm.Package._cache.get("pkg-3") == ids["pkg-3"]
+        assert len(dm.Package._cache) == 2
+    finally:
+        dm.Package._cache.configure(max_size=dm.DEFAULT_CACHE_SIZE)
+
+
+def test_init_cache_config(datanommer_models, mocker):
+    mocker.patch.object(dm.session, "_datanommer_initialized", False)
+    mocker.patch.object(dm.maker, "configure")
+    warm_cache = mocker.patch.object(dm.NamedSingleton, "warm_cache")
+    mocker.patch.object(dm.User, "_cache", dm.LRUCache())
+    mocker.patch.object(dm.Package, "_cache", dm.LRUCache())
+    mocker.patch.object(dm.Message, "grep_cache", None)
+    grep_cache = dm.GrepCache()
+    mocker.patch.object(dm.Message, "default_window", None)
+    mocker.patch.object(dm.Message, "max_window", None)
+    dm.init(
+        "sqlite:///db.db",
+        cache_size=10,
+        cache_ttl=60,
+        warm_cache=True,
+        grep_cache=grep_cache,
+        default_window=datetime.timedelta(days=1),
+        max_window=datetime.timedelta(days=30),
+    )
+    assert dm.Message.default_window == datetime.timedelta(days=1)
+    assert dm.Message.max_window == datetime.timedelta(days=30)
+    assert dm.User._cache.max_size == 10
+    assert dm.Package._cache.ttl == 60
+    assert warm_cache.call_count == 2
+    assert dm.Message.grep_cache is grep_cache
+
+
+def test_lru_cache_lru():
+    cache = dm.LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" is the least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 1, "evictions": 1}
+    cache.configure(max_size=1)
+    assert "c" in cache
+    assert "a" not in cache
+    assert cache.evictions == 2
+
+
+def test_lru_cache_ttl(mocker):
+    monotonic = mocker.patch("datanommer.models.time.monotonic", return_value=100)
+    cache = dm.LRUCache(ttl=10)
+    cache.set("a", 1)
+    monotonic.return_value = 105
+    assert cache.get("a") == 1
+    monotonic.return_value = 111
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert cache.misses == 1
+    # The default TTL can be overridden
+    cache.set("b", 2, ttl=60)
+    monotonic.return_value = 160
+    assert cache.get("b") == 2
+
+
+def test_cache_stats(datanommer_models):
+    dm.User.clear_cache()
+    stats = dm.User.cache_stats()
+    dm.User.get_or_create("dummy")
+    dm.User.get_or_create("dummy")
+    new_stats = dm.User.cache_stats()
+    assert new_stats["size"] == 1
+    assert new_stats["hits"] == stats["hits"] + 1
+    assert new_stats["misses"] == stats["misses"] + 1
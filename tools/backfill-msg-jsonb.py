@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Copy messages.msg to the messages.msg_jsonb column, one time window at a time.
+
+Run it after upgrading the database to the fdfbee46d76f revision and before upgrading to
+the be823a76bd6f revision. It can be interrupted and run again.
+"""
+
+import math
+from datetime import timedelta
+
+import click
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DataError
+
+
+CONVERT = text(
+    "UPDATE messages SET msg_jsonb = replace(msg, '\\u0000', '')::jsonb "
+    "WHERE msg_jsonb IS NULL AND timestamp >= :start AND timestamp < :end"
+)
+# Slower, but handles invalid JSON
+CONVERT_SAFE = text(
+    "UPDATE messages SET msg_jsonb = datanommer_msg_to_jsonb(msg) "
+    "WHERE msg_jsonb IS NULL AND timestamp >= :start AND timestamp < :end"
+)
+
+
+def convert(engine, start, end):
+    params = {"start": start, "end": end}
+    try:
+        with engine.begin() as connection:
+            result = connection.execute(CONVERT, params)
+    except DataError:
+        # Some messages in this window aren't valid JSON.
+        with engine.begin() as connection:
+            result = connection.execute(CONVERT_SAFE, params)
+    return result.rowcount
+
+
+@click.command()
+@click.argument("url")
+@click.option(
+    "--window",
+    default=6,
+    show_default=True,
+    help="Number of hours of messages to convert in each transaction",
+)
+@click.option(
+    "--since", type=click.DateTime(), help="Start at this date instead of the first message"
+)
+def main(url, window, since):
+    engine = create_engine(url, future=True)
+    with engine.connect() as connection:
+        first, last = connection.execute(
+            text("SELECT min(timestamp), max(timestamp) FROM messages")
+        ).one()
+    if first is None:
+        click.echo("No messages.")
+        return
+
+    start = since or first
+    window = timedelta(hours=window)
+    total = 0
+    with click.progressbar(
+        length=max(math.ceil((last - start) / window), 1),
+        label="Converting messages",
+        item_show_func=lambda d: d.strftime("%Y-%m-%d %H:%M") if d else "",
+    ) as bar:
+        while start <= last:
+            end = start + window
+            total += convert(engine, start, end)
+            bar.update(1, start)
+            start = end
+
+    with engine.connect() as connection:
+        remaining = connection.execute(
+            text("SELECT count(*) FROM messages WHERE msg_jsonb IS NULL")
+        ).scalar()
+    click.echo(f"Converted {total} messages, {remaining} remaining.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Measure the speed of the ``contains`` filter of Message.grep() with and without the
+trigram index on the message bodies.
+
+This writes generated messages to the database, so only point it to a disposable database.
+"""
+
+import random
+import time
+import uuid
+
+import click
+from fedora_messaging import message as fedora_message
+from sqlalchemy import text
+
+import datanommer.models as dm
+
+
+WORDS = [uuid.uuid4().hex[:8] for _ in range(5000)]
+
+
+def generate_messages(count):
+    messages = []
+    for index in range(count):
+        msg = fedora_message.Message(
+            topic="org.fedoraproject.benchmark.wiki.article.edit",
+            body={"user": f"user{index % 500}", "summary": " ".join(random.sample(WORDS, 20))},
+        )
+        msg.id = str(uuid.uuid4())
+        messages.append(msg)
+    return messages
+
+
+def measure(label, needles):
+    start = time.perf_counter()
+    found = sum(dm.Message.grep(contains=[needle], rows_per_page=0)[0] for needle in needles)
+    duration = (time.perf_counter() - start) / len(needles)
+    click.echo(f"{label:<20} {duration * 1000:>10.1f} ms/query ({found} messages found)")
+
+
+@click.command()
+@click.option("--url", required=True, help="The database URL (it will be written to!)")
+@click.option(
+    "-n", "--count", default=100000, show_default=True, help="Number of messages to generate"
+)
+@click.option("-q", "--queries", default=20, show_default=True, help="Number of queries")
+def main(url, count, queries):
+    dm.init(url)
+
+    messages = generate_messages(count)
+    for index in range(0, count, 1000):
+        dm.add_many(messages[index : index + 1000])
+    dm.session.execute(text("ANALYZE messages"))
+    dm.session.commit()
+
+    needles = random.sample(WORDS, queries)
+    measure("with the index", needles)
+    # Drop the index in a transaction that is rolled back afterwards
+    dm.session.execute(text("DROP INDEX ix_messages_msg_text"))
+    measure("without the index", needles)
+    dm.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
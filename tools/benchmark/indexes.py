@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Compare the query plans and latencies of the common grep and latest queries, with the
+current indexes and with the single-column indexes they replaced.
+
+This writes generated messages to the database, so only point it to a disposable database.
+"""
+
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import select, text
+
+import datanommer.models as dm
+
+
+CATEGORIES = [f"category{index}" for index in range(10)]
+TOPICS = [
+    f"org.fedoraproject.prod.{category}.event{index}"
+    for category in CATEGORIES
+    for index in range(5)
+]
+AGENTS = [f"agent{index}" for index in range(100)]
+USERS = [f"user{index}" for index in range(1000)]
+PACKAGES = [f"package{index}" for index in range(1000)]
+
+
+def skewed(values):
+    """Pick values with a long tail distribution, like the real topics, agents and users."""
+    weights = [1 / (rank + 1) ** 1.5 for rank in range(len(values))]
+    return lambda k=1: random.choices(values, weights=weights, k=k)  # noqa: S311
+
+
+# Switch back to the previous indexes. This is run in a transaction that is rolled back.
+PREVIOUS_INDEXES = [
+    "DROP INDEX ix_messages_topic_timestamp",
+    "DROP INDEX ix_messages_category_timestamp",
+    "DROP INDEX ix_messages_agent_name_timestamp",
+    "DROP INDEX ix_users_messages_user_id_msg_timestamp",
+    "DROP INDEX ix_packages_messages_package_id_msg_timestamp",
+    "CREATE INDEX ix_messages_topic ON messages (topic)",
+    "CREATE INDEX ix_messages_category ON messages (category)",
+    "CREATE INDEX ix_messages_agent_name ON messages (agent_name)",
+    "ANALYZE messages, users_messages, packages_messages",
+]
+
+
+def generate_messages(count, days):
+    end = datetime.now()
+    pick_topic, pick_agent = skewed(TOPICS), skewed(AGENTS)
+    pick_user, pick_package = skewed(USERS), skewed(PACKAGES)
+    messages = []
+    for index in range(count):
+        messages.append(
+            {
+                "i": 0,
+                "msg_id": str(uuid.uuid4()),
+                "topic": pick_topic()[0],
+                "timestamp": end - timedelta(seconds=days * 86400 * index / count),
+                "msg": {"index": index},
+                "headers": {},
+                "agent_name": pick_agent()[0],
+                "users": set(pick_user(2)),
+                "packages": pick_package(),
+            }
+        )
+    return messages
+
+
+def get_queries():
+    start = datetime.now() - timedelta(days=30)
+    end = datetime.now()
+    # Query the values at the end of the long tail
+    return {
+        "grep topic": dm.Message.make_query(topics=[TOPICS[-1]]),
+        "grep category": dm.Message.make_query(categories=[CATEGORIES[-1]]),
+        "grep agent": dm.Message.make_query(agents=[AGENTS[-1]]),
+        "grep user": dm.Message.make_query(users=[USERS[-1]]),
+        "grep user, 30 days": dm.Message.make_query(start=start, end=end, users=[USERS[-1]]),
+        "grep package, 30 days": dm.Message.make_query(
+            start=start, end=end, packages=[PACKAGES[-1]]
+        ),
+        "latest topic": select(dm.Message).where(dm.Message.topic == TOPICS[-1]),
+        "latest category": select(dm.Message).where(dm.Message.category == CATEGORIES[-1]),
+    }
+
+
+def plan_summary(plan):
+    """List the scans of a query plan."""
+    nodes = []
+    if "Scan" in plan["Node Type"]:
+        nodes.append(f"{plan['Node Type']} {plan.get('Index Name', plan.get('Relation Name'))}")
+    for subplan in plan.get("Plans", []):
+        nodes.extend(plan_summary(subplan))
+    return nodes
+
+
+def measure(label, repeat):
+    click.echo(f"\n{label}")
+    for name, query in get_queries().items():
+        query = query.order_by(dm.Message.timestamp.desc()).limit(20)
+        plan = dm.session.scalar(dm._Explain(query))[0]["Plan"]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            dm.session.scalars(query).all()
+        duration = (time.perf_counter() - start) / repeat
+        click.echo(f"  {name:<25} {duration * 1000:>8.2f} ms  {', '.join(plan_summary(plan))}")
+
+
+@click.command()
+@click.option("--url", required=True, help="The database URL (it will be written to!)")
+@click.option("-n", "--count", default=200000, show_default=True, help="Number of messages")
+@click.option("-d", "--days", default=365, show_default=True, help="Time span of the messages")
+@click.option("-r", "--repeat", default=20, show_default=True, help="Runs of each query")
+def main(url, count, days, repeat):
+    dm.init(url)
+
+    messages = generate_messages(count, days)
+    for index in range(0, count, 1000):
+        dm.Message.bulk_create(messages[index : index + 1000])
+        dm.session.commit()
+    dm.session.execute(text("ANALYZE messages, users_messages, packages_messages"))
+    dm.session.commit()
+
+    measure("Current indexes", repeat)
+    for statement in PREVIOUS_INDEXES:
+        dm.session.execute(text(statement))
+    measure("Previous indexes", repeat)
+    dm.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
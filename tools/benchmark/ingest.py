@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Measure the ingestion throughput of datanommer.models.
+
+This writes generated messages to the database, so only point it to a disposable database.
+"""
+
+import time
+import uuid
+
+import click
+from fedora_messaging import message as fedora_message
+
+import datanommer.models as dm
+from datanommer.consumer import WorkerPool
+
+
+def generate_messages(count):
+    messages = []
+    for index in range(count):
+        msg = fedora_message.Message(
+            topic="org.fedoraproject.benchmark.buildsys.build.state.change",
+            body={"build_id": index, "owner": f"user{index % 50}", "name": f"pkg{index % 200}"},
+        )
+        msg.id = str(uuid.uuid4())
+        messages.append(msg)
+    return messages
+
+
+def measure(label, count, func):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    click.echo(f"{label:<30} {count / duration:>10.0f} msg/s ({duration:.2f}s)")
+
+
+@click.command()
+@click.option("--url", required=True, help="The database URL (it will be written to!)")
+@click.option("-n", "--count", default=5000, show_default=True, help="Number of messages")
+@click.option(
+    "-b",
+    "--batch-size",
+    "batch_sizes",
+    multiple=True,
+    type=int,
+    default=[10, 100, 1000],
+    show_default=True,
+    help="Batch sizes to compare with the per-message path",
+)
+@click.option(
+    "-w",
+    "--workers",
+    "worker_counts",
+    multiple=True,
+    type=int,
+    default=[],
+    help="Worker pool sizes to compare, using the largest batch size",
+)
+def main(url, count, batch_sizes, worker_counts):
+    dm.init(url)
+
+    messages = generate_messages(count)
+    measure("per message", count, lambda: [dm.add(msg) for msg in messages])
+
+    for batch_size in batch_sizes:
+        messages = generate_messages(count)
+
+        def run(messages=messages, batch_size=batch_size):
+            for index in range(0, count, batch_size):
+                dm.add_many(messages[index : index + batch_size])
+
+        measure(f"batches of {batch_size}", count, run)
+
+    batch_size = max(batch_sizes)
+    for workers in worker_counts:
+        pool = WorkerPool(workers, url)
+        # Start the worker processes before measuring
+        pool.add_many(generate_messages(workers))
+        messages = generate_messages(count)
+
+        def run(messages=messages, pool=pool):
+            for index in range(0, count, batch_size):
+                pool.add_many(messages[index : index + batch_size])
+
+        measure(f"{workers} workers", count, run)
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Measure the Python-side overhead of Message.make_query() and Message.grep().
+
+The queries run on an empty database, so that the time is spent building, compiling and
+executing the statements rather than in PostgreSQL. The filter lists have random lengths,
+like the queries of a web frontend.
+"""
+
+import random
+import time
+
+import click
+from sqlalchemy import text
+
+import datanommer.models as dm
+
+
+def random_filters(count):
+    filters = []
+    for _ in range(count):
+        filters.append(
+            {
+                name: [f"{name}{index}" for index in range(random.randint(1, 50))]  # noqa: S311
+                for name in ("topics", "categories", "not_agents")
+            }
+        )
+    return filters
+
+
+def measure(label, count, func):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    click.echo(f"{label:<20} {duration / count * 1000000:>10.0f} µs/call")
+
+
+@click.command()
+@click.option("--url", required=True, help="The database URL, it must not have messages")
+@click.option("-n", "--count", default=2000, show_default=True, help="Number of calls")
+def main(url, count):
+    dm.init(url)
+    if dm.session.scalar(text("SELECT count(*) FROM messages")):
+        raise click.ClickException("The database must not have messages")
+    filters = random_filters(count)
+    # Warm up
+    for kwargs in filters[:100]:
+        dm.Message.grep(**kwargs)
+
+    measure("make_query", count, lambda: [dm.Message.make_query(**kw) for kw in filters])
+    measure("grep", count, lambda: [dm.Message.grep(**kw) for kw in filters])
+    measure(
+        "grep without count",
+        count,
+        lambda: [dm.Message.grep(count="none", **kw) for kw in filters],
+    )
+    engine = dm.session.get_bind()
+    click.echo(f"compiled cache size: {len(engine._compiled_cache)}")
+
+
+if __name__ == "__main__":
+    main()